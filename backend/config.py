@@ -1,5 +1,6 @@
+from pydantic import model_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
-from typing import Optional
+from typing import Dict, List, Optional
 
 
 class Settings(BaseSettings):
@@ -9,6 +10,212 @@ class Settings(BaseSettings):
     # Optional pagination defaults
     default_page_size: int = 20
     max_page_size: int = 100
+
+    # Retrieval settings
+    # Chunks scoring below prefetch_min_score (cosine) are dropped, as are chunks
+    # scoring below prefetch_relative_score * best score of the turn.
+    prefetch_min_score: float = 0.25
+    prefetch_relative_score: float = 0.5
+
+    # Notebook routing: prefetch only fans out to the routing_top_k notebooks whose
+    # centroid is closest to the refined query (0 disables routing). With
+    # routing_fallback_all, all notebooks are searched when no centroid scores
+    # above routing_min_score. Notebooks without a centroid yet are always searched.
+    routing_top_k: int = 3
+    routing_min_score: float = 0.2
+    routing_fallback_all: bool = True
+
+    # Post-retrieval diversification: fetch limit * mmr_fetch_factor candidates,
+    # keep limit of them by Maximal Marginal Relevance and stitch adjacent chunks.
+    retrieval_mmr: bool = True
+    mmr_fetch_factor: int = 3
+    mmr_lambda: float = 0.7
+
+    # Token budgets for retrieved context packed into each stage's prompt
+    prefetch_context_tokens: int = 2000
+    tool_context_tokens: int = 1500
+
+    # Max tool calls of one assistant turn executed concurrently (1 runs them in order)
+    tool_call_concurrency: int = 4
+    # Expose the search_data_batch tool (many {notebook, query} pairs in one call)
+    batch_search_tool: bool = True
+
+    # Per-request budget for the chat pipeline. When the next tool round would
+    # exceed it, the main model is forced to answer (tool_choice="none").
+    # budget_final_answer_output_tokens of the output budget are kept for the answer.
+    budget_deadline_seconds: float = 60.0
+    budget_max_tool_rounds: int = 6
+    budget_max_input_tokens: int = 150000
+    budget_max_output_tokens: int = 8000
+    budget_max_cost: float = 0.5
+    budget_final_answer_reserve_seconds: float = 15.0
+    budget_final_answer_output_tokens: int = 2000
+
+    # Speculative retrieval: search with the raw user query while the query is
+    # being refined, reuse the results if both embeddings are this similar
+    speculative_retrieval: bool = True
+    speculative_min_similarity: float = 0.9
+
+    # Batched prefetch extraction: one structured-output call for all notebooks
+    # (the prefetch_batch route needs models with json_schema support), falling
+    # back to per-notebook calls when the packed prompt is above prefetch_batch_max_tokens
+    prefetch_batched_extraction: bool = False
+    prefetch_batch_max_tokens: int = 12000
+
+    # History compaction: the last history_keep_turns turns are sent verbatim,
+    # older turns are folded into a running summary. Folding happens in batches
+    # of history_compact_batch_turns (so the prompt prefix stays stable between
+    # compactions) or earlier when the verbatim part exceeds history_max_tokens
+    history_compaction: bool = True
+    history_keep_turns: int = 4
+    history_compact_batch_turns: int = 4
+    history_max_tokens: int = 6000
+    history_summary_tokens: int = 500
+
+    # Semantic answer cache for first-turn questions: a stored answer is reused
+    # when the refined query embedding is this similar and the notebooks are unchanged
+    answer_cache: bool = True
+    answer_cache_min_similarity: float = 0.95
+    answer_cache_ttl_seconds: float = 3600.0
+    answer_cache_max_entries: int = 1000
+
+    # Prefetch memo: per-notebook prefetch output keyed by notebook content
+    # version, refined query and prompt version. "memory" or "postgres"
+    # (shared between workers, with the in-memory cache in front)
+    prefetch_memo: bool = True
+    prefetch_memo_backend: str = "memory"
+    prefetch_memo_ttl_seconds: float = 86400.0
+    prefetch_memo_max_entries: int = 5000
+
+    # Context dedup: chunks already delivered to the main model in full during
+    # this turn are sent as short [C<n>] references instead of full text
+    context_dedup: bool = True
+
+    # Query embedding micro-batching: concurrent requests are collected for up
+    # to embedding_batch_window_ms (or embedding_batch_max_items texts) and
+    # embedded with one OpenAI call. A caller gives up after
+    # embedding_batch_timeout_seconds (covers the SDK's retries)
+    embedding_batching: bool = True
+    embedding_batch_window_ms: float = 5.0
+    embedding_batch_max_items: int = 64
+    embedding_batch_timeout_seconds: float = 30.0
+
+    # OpenAI scheduler: calls queue per model behind RPM/TPM token buckets that
+    # follow the x-ratelimit-* response headers. Interactive calls always go
+    # first; bulk calls (ingest embeddings, OCR) leave openai_bulk_reserve of
+    # each bucket free for them
+    openai_scheduler: bool = True
+    openai_default_rpm: int = 500
+    openai_default_tpm: int = 200000
+    openai_bulk_reserve: float = 0.2
+
+    # OpenAI transport: pooled keep-alive connections (HTTP/2 where the server
+    # negotiates it), SDK retries with jittered exponential backoff and per-stage
+    # read timeouts, capped by the request budget
+    openai_http2: bool = True
+    openai_max_connections: int = 100
+    openai_max_keepalive_connections: int = 20
+    openai_keepalive_expiry_seconds: float = 30.0
+    openai_connect_timeout: float = 3.0
+    openai_max_retries: int = 2
+    openai_stage_timeouts: Dict[str, float] = {
+        "refine": 8.0,
+        "prefetch": 20.0,
+        "summary": 30.0,
+        "embedding": 8.0,
+        "ocr": 60.0,
+        "main": 60.0,
+    }
+    # Hedged requests for small latency-critical calls: an identical second call
+    # goes out when the first hasn't answered after the stage's delay (0 disables)
+    openai_hedge_delays_ms: Dict[str, float] = {"refine": 1500.0, "embedding": 400.0}
+
+    # Circuit breaker per model: after breaker_failure_threshold consecutive
+    # failures (5xx, timeouts, connection errors) its calls fail fast for
+    # breaker_reset_seconds, then one probe call decides whether it closes.
+    # While the prefetch model's breaker is open, prefetch is skipped
+    breaker_failure_threshold: int = 5
+    breaker_reset_seconds: float = 30.0
+
+    # Model routing: each stage's models in order of preference. A model is
+    # skipped while its circuit breaker is open, the prompt is above its
+    # llm_max_prompt_tokens, or its recent error rate (above llm_max_error_rate)
+    # or latency (above the stage's target) on that stage is too high. Stats
+    # older than llm_stats_ttl_seconds are forgotten, so skipped models get retried;
+    # stats need llm_min_samples calls before they can skip a model. Only
+    # connection errors, timeouts, 429 and 5xx count as errors, and such an error
+    # retries the call on the stage's next model. Every routed model needs a price
+    # in llm_prices (USD per 1M input and output tokens) for budget_max_cost.
+    # "main" is the first main model call of a turn, "tool_rounds" the calls after tool results
+    llm_routes: Dict[str, List[str]] = {
+        "refine": ["gpt-3.5-turbo", "gpt-4o-mini"],
+        "prefetch": ["gpt-3.5-turbo", "gpt-4o-mini"],
+        "prefetch_batch": ["gpt-4o-mini", "gpt-4o"],
+        "summary": ["gpt-3.5-turbo", "gpt-4o-mini"],
+        "history_summary": ["gpt-4o-mini", "gpt-3.5-turbo"],
+        "main": ["gpt-4o", "gpt-4o-mini"],
+        "tool_rounds": ["gpt-4o", "gpt-4o-mini"],
+        "ocr": ["gpt-4o-mini", "gpt-4o"],
+    }
+    # Latency targets in ms; for the streamed main stages this is time to first byte
+    llm_latency_targets_ms: Dict[str, float] = {
+        "refine": 2000.0,
+        "prefetch": 5000.0,
+        "prefetch_batch": 8000.0,
+        "summary": 10000.0,
+        "history_summary": 10000.0,
+        "main": 4000.0,
+        "tool_rounds": 4000.0,
+        "ocr": 30000.0,
+    }
+    llm_max_prompt_tokens: Dict[str, int] = {
+        "gpt-3.5-turbo": 15000,
+        "gpt-4o-mini": 120000,
+        "gpt-4o": 120000,
+    }
+    llm_max_error_rate: float = 0.5
+    llm_stats_ttl_seconds: float = 120.0
+    llm_min_samples: int = 5
+    llm_prices: Dict[str, List[float]] = {
+        "gpt-4o": [2.50, 10.00],
+        "gpt-4o-mini": [0.15, 0.60],
+        "gpt-3.5-turbo": [0.50, 1.50],
+    }
+
+    # Idempotency-Key support on the completion endpoints: a repeated key joins
+    # the in-flight request (waiting up to idempotency_wait_seconds) or replays
+    # its response for idempotency_ttl_seconds. "memory" (this process only) or
+    # "postgres" (shared between workers)
+    idempotency_backend: str = "postgres"
+    idempotency_ttl_seconds: float = 600.0
+    idempotency_wait_seconds: float = 120.0
+    idempotency_max_entries: int = 10000
+
+    # Full execution logs (prefetch, tool calls, budget, routing...) of each
+    # completion are kept for execution_log_ttl_seconds and fetched by id from
+    # GET /api/chat/logs/{log_id}; compact responses only carry the answer,
+    # references and the log id. "memory" keeps up to execution_log_max_bytes of
+    # serialized logs per worker and only that worker can return them, so
+    # multi-worker deployments need "postgres"
+    execution_log_backend: str = "memory"
+    execution_log_ttl_seconds: float = 3600.0
+    execution_log_max_bytes: int = 32000000
+
+    # Admission control for the completion endpoints: at most
+    # admission_max_concurrent pipelines run at once, and each client (its
+    # address) has at most admission_max_per_client running or queued. The rest
+    # wait in a FIFO queue of admission_max_queue for up to
+    # admission_queue_timeout_seconds, else get 429 with Retry-After. Queued
+    # requests hold a server worker thread, so keep max_concurrent + max_queue
+    # below the thread pool size (40 by default)
+    admission_control: bool = True
+    admission_max_concurrent: int = 8
+    admission_max_per_client: int = 3
+    admission_max_queue: int = 16
+    admission_queue_timeout_seconds: float = 20.0
+    # Header naming the client instead of its address; only set this behind a
+    # proxy that overwrites it, since clients can put anything in it
+    admission_client_header: Optional[str] = None
     
     model_config = SettingsConfigDict(
         env_file=".env",
@@ -17,6 +224,21 @@ class Settings(BaseSettings):
         extra="ignore"
     )
 
+    @model_validator(mode="after")
+    def check_llm_prices(self):
+        # An unpriced model would cost $0 and escape budget_max_cost
+        unpriced = sorted({model for models in self.llm_routes.values() for model in models} - set(self.llm_prices))
+        if unpriced:
+            raise ValueError(f"llm_routes uses models without llm_prices: {', '.join(unpriced)}")
+        return self
+
+    @model_validator(mode="after")
+    def fill_stage_timeouts(self):
+        # Stages without a timeout use "main"; an override without it keeps the default one
+        default = type(self).model_fields["openai_stage_timeouts"].default["main"]
+        self.openai_stage_timeouts.setdefault("main", default)
+        return self
+
 
 settings = Settings()
 
@@ -41,6 +41,6 @@ def init_db():
     It does NOT modify existing tables or add new columns to existing tables.
     For schema changes (like adding columns), use Alembic migrations or manual SQL.
     """
-    from models import Chat, Message
+    from models import Chat, Message, PrefetchMemoEntry, IdempotencyRecord, ExecutionLog
     Base.metadata.create_all(bind=engine)
 
@@ -0,0 +1,60 @@
+import json
+import time
+from config import settings
+from services.ai_wrapper import execute_chat, summarize_notebooks
+
+# Questions that trigger DEEP ANALYSIS mode (3-7 searches each)
+questions = [
+    "Дай детальний аналіз теорії графів 🔍",
+    "Give me a comprehensive analysis of Boolean functions and their minimization 🔍",
+    "Detailed report on trees: binary trees, AVL trees and spanning trees 🔍",
+]
+
+
+def run_question(notebook_summary: str, question: str, notebooks: list[str]):
+    messages = [{"role": "user", "content": question}]
+    start = time.perf_counter()
+    _, logs = execute_chat(messages, [], notebooks, notebook_summary=notebook_summary)
+    elapsed = time.perf_counter() - start
+    searches = 0
+    for turn in logs["main_llm"]:
+        for tool_call in turn["tool_calls"]:
+            if tool_call["name"] == "search_data_batch":
+                searches += len(json.loads(tool_call["arguments"]).get("searches", []))
+            else:
+                searches += 1
+    return {
+        "llm_round_trips": len(logs["main_llm"]),
+        "searches": searches,
+        "seconds": round(elapsed, 2),
+    }
+
+
+def run_tests():
+    notebooks = ["discrete_math"]
+    notebook_summary = summarize_notebooks(notebooks)
+    # Every question runs twice, the second run must not be served by the answer cache or the prefetch memo
+    settings.answer_cache = False
+    settings.prefetch_memo = False
+
+    results = []
+    for q in questions:
+        print(f"Running deep analysis test for: {q}")
+        settings.batch_search_tool = False
+        single = run_question(notebook_summary, q, notebooks)
+        settings.batch_search_tool = True
+        batched = run_question(notebook_summary, q, notebooks)
+        results.append({"question": q, "single_search": single, "batch_search": batched})
+
+    for mode in ("single_search", "batch_search"):
+        trips = sum(r[mode]["llm_round_trips"] for r in results) / len(results)
+        seconds = sum(r[mode]["seconds"] for r in results) / len(results)
+        print(f"{mode}: {trips:.1f} LLM round trips, {seconds:.1f}s per answer")
+
+    with open("deep_analysis_test_results.json", "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2, ensure_ascii=False)
+
+    print("Results saved to deep_analysis_test_results.json")
+
+if __name__ == "__main__":
+    run_tests()
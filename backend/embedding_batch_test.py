@@ -0,0 +1,110 @@
+import base64
+import json
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from openai import OpenAI
+from services.embedding_batcher import EmbeddingBatcher
+
+# Fake embedding server: fixed per-request overhead plus a small per-item cost,
+# with a cap on concurrent requests (like a connection pool / rate limit)
+REQUEST_LATENCY = 0.05
+ITEM_LATENCY = 0.0005
+MAX_CONCURRENT_REQUESTS = 8
+VECTOR_SIZE = 1536
+
+concurrent_requests = threading.Semaphore(MAX_CONCURRENT_REQUESTS)
+vector = [0.1] * VECTOR_SIZE
+# The OpenAI client asks for base64-encoded float32 vectors by default
+vector_base64 = base64.b64encode(struct.pack(f"{VECTOR_SIZE}f", *vector)).decode("ascii")
+
+
+class FakeEmbeddingHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        with concurrent_requests:
+            time.sleep(REQUEST_LATENCY + ITEM_LATENCY * len(texts))
+        embedding = vector_base64 if body.get("encoding_format") == "base64" else vector
+        data = [
+            {"object": "embedding", "index": i, "embedding": embedding}
+            for i in range(len(texts))
+        ]
+        payload = json.dumps({
+            "object": "list",
+            "data": data,
+            "model": body["model"],
+            "usage": {"prompt_tokens": len(texts), "total_tokens": len(texts)},
+        }).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeEmbeddingServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+
+concurrencies = [1, 8, 32, 64]
+queries_per_worker = 10
+
+
+def run_load(embed, concurrency: int):
+    def worker(worker_id: int):
+        latencies = []
+        for i in range(queries_per_worker):
+            start = time.perf_counter()
+            embed([f"query {worker_id}-{i}"])
+            latencies.append(time.perf_counter() - start)
+        return latencies
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = [l for result in executor.map(worker, range(concurrency)) for l in result]
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "queries_per_second": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 1),
+        "p99_ms": round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 1),
+    }
+
+
+def run_tests():
+    server = FakeEmbeddingServer(("127.0.0.1", 0), FakeEmbeddingHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    client = OpenAI(api_key="test", base_url=f"http://127.0.0.1:{server.server_port}/v1", max_retries=0)
+
+    def embed(texts: list[str]) -> list[list[float]]:
+        response = client.embeddings.create(model="text-embedding-3-small", input=texts)
+        return [item.embedding for item in response.data]
+
+    results = []
+    for concurrency in concurrencies:
+        batcher = EmbeddingBatcher(embed, window_ms=5.0, max_batch=64)
+        direct = run_load(embed, concurrency)
+        batched = run_load(batcher.embed, concurrency)
+        batched["calls"] = batcher.batches
+        results.append({"concurrency": concurrency, "direct": direct, "batched": batched})
+        print(
+            f"concurrency={concurrency:>3}: direct {direct['queries_per_second']:>7} q/s "
+            f"(p99 {direct['p99_ms']} ms), batched {batched['queries_per_second']:>7} q/s "
+            f"(p99 {batched['p99_ms']} ms, {batcher.batches} calls for {batcher.requests} requests)"
+        )
+
+    server.shutdown()
+    with open("embedding_batch_test_results.json", "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2, ensure_ascii=False)
+
+    print("Results saved to embedding_batch_test_results.json")
+
+if __name__ == "__main__":
+    run_tests()
@@ -0,0 +1,67 @@
+import json
+from config import settings
+from services.ai_wrapper import execute_chat, summarize_notebooks
+
+# One long conversation, asked turn by turn
+questions = [
+    "What is a graph in discrete mathematics?",
+    "What is the difference between directed and undirected graphs?",
+    "What is an Eulerian cycle?",
+    "And a Hamiltonian cycle?",
+    "How does Dijkstra's algorithm work?",
+    "What is its time complexity?",
+    "What is a spanning tree?",
+    "Compare Prim's and Kruskal's algorithms.",
+    "What is an AVL tree?",
+    "How are AVL trees rebalanced?",
+    "What is a binary search tree?",
+    "Summarize everything we discussed about graphs so far.",
+]
+
+
+def run_conversation(notebooks: list[str], notebook_summary: str):
+    messages = []
+    history_state = {}
+    ledger_state = {}
+    turns = []
+    for i, q in enumerate(questions):
+        messages.append({"role": "user", "content": q})
+        response_messages, logs = execute_chat(
+            messages, [], notebooks, notebook_summary=notebook_summary, history_state=history_state,
+            ledger_state=ledger_state
+        )
+        messages.extend(response_messages)
+        turns.append({
+            "turn": i + 1,
+            "history_tokens": logs["history"]["tokens"],
+            "original_history_tokens": logs["history"]["original_tokens"],
+            "main_input_tokens": logs["main_llm"][0].get("input_tokens", 0),
+            "dedup_saved_tokens": logs.get("dedup", {}).get("saved_tokens", 0),
+        })
+    return turns
+
+
+def run_tests():
+    notebooks = ["discrete_math"]
+    notebook_summary = summarize_notebooks(notebooks)
+    # The conversation runs twice, the second run must not be served by the answer cache or the prefetch memo
+    settings.answer_cache = False
+    settings.prefetch_memo = False
+
+    results = {}
+    for compaction in (False, True):
+        print(f"Running conversation with history_compaction={compaction}")
+        settings.history_compaction = compaction
+        results[f"compaction_{compaction}"] = run_conversation(notebooks, notebook_summary)
+
+    print("turn  history(off)  history(on)  input(off)  input(on)  dedup saved(on)")
+    for off, on in zip(results["compaction_False"], results["compaction_True"]):
+        print(f"{off['turn']:>4}  {off['history_tokens']:>12}  {on['history_tokens']:>11}  {off['main_input_tokens']:>10}  {on['main_input_tokens']:>9}  {on['dedup_saved_tokens']:>15}")
+
+    with open("history_test_results.json", "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2, ensure_ascii=False)
+
+    print("Results saved to history_test_results.json")
+
+if __name__ == "__main__":
+    run_tests()
@@ -11,12 +11,12 @@ Usage:
     python init_database.py
 """
 from database import init_db
-from models import Chat, Message
+from models import Chat, Message, PrefetchMemoEntry, IdempotencyRecord, ExecutionLog
 
 
 if __name__ == "__main__":
     print("Initializing database...")
-    print("Creating tables: chats, messages")
+    print("Creating tables: chats, messages, prefetch_memo, idempotency_keys, execution_logs")
     print("Note: This will only create tables if they don't exist.")
     print("      Existing tables will NOT be modified.\n")
     init_db()
@@ -1,7 +1,7 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
-from routers import chats, messages, chat_completion, notebooks
+from routers import chats, messages, chat_completion, notebooks, metrics
 
 # To initialize database tables, run: python init_database.py
 # Or use Alembic migrations for production
@@ -19,13 +19,17 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Read by the frontend's retry logic
+    expose_headers=["Retry-After", "Idempotent-Replayed"],
 )
 
 # Include routers
 app.include_router(chats.router)
 app.include_router(messages.router)
 app.include_router(chat_completion.router)
+app.include_router(chat_completion.chats_router)
 app.include_router(notebooks.router)
+app.include_router(metrics.router)
 
 
 @app.get("/")
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, ARRAY
+from sqlalchemy import Column, Integer, BigInteger, String, Text, DateTime, ForeignKey, ARRAY, JSON
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from datetime import datetime
@@ -15,6 +15,12 @@ class Chat(Base):
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String(255), nullable=True)  # Chat name/title
     notebooks = Column(ARRAY(String), nullable=False, default=[])  # Array of notebook identifiers
+    history_summary = Column(Text, nullable=True)  # Running summary of older turns
+    history_summary_count = Column(Integer, nullable=False, default=0, server_default="0")  # Messages covered by the summary
+    history_summary_hash = Column(String(64), nullable=True)  # sha256 of the messages covered by the summary
+    keywords = Column(ARRAY(String), nullable=False, default=[], server_default="{}")  # Prefetch context keywords
+    notebook_summary = Column(Text, nullable=True)  # Cached summary of the chat's notebooks
+    context_ledger = Column(JSON, nullable=True)  # Context dedup reference counter and this turn's delivered chunks
     created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now(), nullable=False)
     
@@ -45,3 +51,55 @@ class Message(Base):
     def __repr__(self):
         return f"<Message(id={self.id}, chat_id={self.chat_id}, role={self.role})>"
 
+
+class PrefetchMemoEntry(Base):
+    """
+    Prefetch memo stores per-notebook prefetch output, keyed by notebook,
+    content version, refined query and prompt version.
+    Only used when PREFETCH_MEMO_BACKEND=postgres.
+    """
+    __tablename__ = "prefetch_memo"
+    
+    key = Column(String(64), primary_key=True)  # sha256 of the memo key parts
+    notebook = Column(String(255), nullable=False, index=True)
+    version = Column(BigInteger, nullable=True)  # Notebook content version
+    value = Column(JSON, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False, index=True)
+    
+    def __repr__(self):
+        return f"<PrefetchMemoEntry(notebook={self.notebook}, version={self.version})>"
+
+
+class IdempotencyRecord(Base):
+    """
+    Idempotency record stores the state and response of a completion request
+    sent with an Idempotency-Key, so retries from any worker replay it.
+    Only used when IDEMPOTENCY_BACKEND=postgres.
+    """
+    __tablename__ = "idempotency_keys"
+    
+    key = Column(String(64), primary_key=True)  # sha256 of endpoint + client key
+    request_hash = Column(String(64), nullable=False)  # sha256 of the request body
+    status = Column(String(20), nullable=False)  # "in_progress" or "completed"
+    response = Column(JSON, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    completed_at = Column(DateTime(timezone=True), nullable=True, index=True)
+    
+    def __repr__(self):
+        return f"<IdempotencyRecord(key={self.key}, status={self.status})>"
+
+
+class ExecutionLog(Base):
+    """
+    Execution log stores the full logs of a completion (prefetch, tool calls,
+    budget, routing...) for the debug panel, fetched by id.
+    Only used when EXECUTION_LOG_BACKEND=postgres.
+    """
+    __tablename__ = "execution_logs"
+    
+    id = Column(String(32), primary_key=True)  # uuid4 hex
+    data = Column(JSON, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False, index=True)
+    
+    def __repr__(self):
+        return f"<ExecutionLog(id={self.id})>"
@@ -0,0 +1,56 @@
+import json
+import time
+from config import settings
+from services.rag import rag_service
+from services.ai_wrapper import prefetch
+
+question = "Describe the main steps of Dijkstra's algorithm for finding the shortest path in a weighted graph."
+notebook_counts = [1, 3, 8]
+
+
+def run_prefetch(notebooks: list[str]):
+    start = time.perf_counter()
+    _, logs = prefetch(question, [], notebooks)
+    elapsed = time.perf_counter() - start
+    prompt_tokens = sum(n.get("input_tokens", 0) for n in logs["notebooks"])
+    prompt_tokens += logs.get("batch", {}).get("input_tokens", 0)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "seconds": round(elapsed, 2),
+        "batch_status": logs.get("batch", {}).get("status"),
+    }
+
+
+def run_tests():
+    available = rag_service.list_notebooks()
+    # Compare extraction only, every notebook gets prefetched
+    settings.routing_top_k = 0
+    settings.prefetch_min_score = 0.0
+    settings.prefetch_relative_score = 0.0
+    # Both arms extract the same notebooks, the second one must not be served by the prefetch memo
+    settings.prefetch_memo = False
+
+    results = []
+    for count in notebook_counts:
+        if count > len(available):
+            print(f"Skipping {count} notebooks: only {len(available)} available")
+            continue
+        notebooks = available[:count]
+        print(f"Running prefetch for {count} notebook(s)")
+
+        settings.prefetch_batched_extraction = False
+        per_notebook = run_prefetch(notebooks)
+        settings.prefetch_batched_extraction = True
+        batched = run_prefetch(notebooks)
+
+        results.append({"notebooks": count, "per_notebook": per_notebook, "batched": batched})
+        print(f"  per-notebook: {per_notebook['prompt_tokens']} tokens, {per_notebook['seconds']}s")
+        print(f"  batched:      {batched['prompt_tokens']} tokens, {batched['seconds']}s")
+
+    with open("prefetch_batch_test_results.json", "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2, ensure_ascii=False)
+
+    print("Results saved to prefetch_batch_test_results.json")
+
+if __name__ == "__main__":
+    run_tests()
@@ -1,5 +1,5 @@
 import json
-from services.prompts import MAIN_LLM_SYSTEM
+from config import settings
 from services.rag import rag_service
 from services.ai_wrapper import execute_chat, summarize_notebooks
 
@@ -21,18 +21,17 @@ questions = [
 def run_tests():
     notebooks = ["discrete_math"]
     notebook_summary = summarize_notebooks(notebooks)
-    system_prompt = MAIN_LLM_SYSTEM.format(notebook_summary=notebook_summary)
     
     results = []
     
     for q in questions:
         print(f"Running test for: {q}")
-        messages = [{"role": "system", "content": system_prompt}]
+        messages = []
         keywords = []
         
         messages.append({"role": "user", "content": q})
         
-        response_messages, logs = execute_chat(messages, keywords, notebooks)
+        response_messages, logs = execute_chat(messages, keywords, notebooks, notebook_summary=notebook_summary)
             
         final_response = response_messages[-1]["content"]
         print(list(map(lambda x: x["tool_calls"], logs["main_llm"])))
@@ -43,21 +42,32 @@ def run_tests():
         
         input_data = {
             "initial_prompt": logs["input"],
-            "tool_outputs": tool_outputs
+            "tool_outputs": tool_outputs,
+            "tool_tokens": logs["tool_tokens"]
         }
 
         test_result = {
                 "question": q,
                 "response": final_response,
                 "input": input_data,
-                "total_input_tokens": sum(x.get("input_tokens", 0) for x in logs["prefetch"]["notebooks"]),
-                "total_output_tokens": sum(x.get("output_tokens", 0) for x in logs["prefetch"]["notebooks"]) + logs["tool_tokens"]
+                "retrieval_mmr": settings.retrieval_mmr,
+                "main_input_tokens": sum(turn.get("input_tokens", 0) for turn in logs["main_llm"]),
+                "main_cached_tokens": sum(turn.get("cached_tokens", 0) for turn in logs["main_llm"]),
+                "total_input_tokens": sum(x.get("input_tokens", 0) for x in logs["prefetch"]["notebooks"]) + logs["prefetch"].get("batch", {}).get("input_tokens", 0),
+                "total_output_tokens": sum(x.get("output_tokens", 0) for x in logs["prefetch"]["notebooks"]) + logs["prefetch"].get("batch", {}).get("output_tokens", 0) + logs["tool_tokens"]
             }
         results.append(test_result)
         print(f"Completed: {q}")
             
 
 
+    # Compare runs with RETRIEVAL_MMR=false / true to see the prompt token savings
+    prompt_tokens = sum(r["total_input_tokens"] + r["input"]["tool_tokens"] for r in results)
+    print(f"Prompt tokens per turn (retrieval_mmr={settings.retrieval_mmr}): {prompt_tokens / len(results):.0f}")
+    main_input = sum(r["main_input_tokens"] for r in results)
+    main_cached = sum(r["main_cached_tokens"] for r in results)
+    print(f"Main model prompt cache hit rate: {main_cached / main_input if main_input else 0:.1%}")
+
     with open("rag_test_results.json", "w", encoding="utf-8") as f:
         json.dump(results, f, indent=2, ensure_ascii=False)
     
@@ -1,73 +1,471 @@
-from fastapi import APIRouter, HTTPException, status
-from pydantic import BaseModel
-from typing import List, Optional, Dict, Any
+from fastapi import APIRouter, HTTPException, Request, Response, status
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
+from typing import List, Literal, Optional, Dict, Any
+import hashlib
+import json
+import queue
+import threading
+from contextlib import contextmanager
+from config import settings
+from database import SessionLocal
+from schemas import MessageResponse
 from services import ai_wrapper
-from services.prompts import MAIN_LLM_SYSTEM
+from services.admission import admission_controller, AdmissionRejected
+from services.answer_cache import cache_mode_from_headers
+from services.idempotency import (
+    idempotency_store,
+    idempotency_scope,
+    IdempotencyConflict,
+    IdempotencyKeyMismatch,
+)
+from services.chat_service import ChatService
+from services.execution_log_store import execution_log_store
+from services.budget import Budget
+from services.openai_service import scheduling_client
 
 router = APIRouter(prefix="/api/chat", tags=["chat"])
 
+# Stored message roles -> OpenAI roles; stored system messages aren't replayed
+MESSAGE_ROLES = {"user": "user", "ai": "assistant"}
+
 class Message(BaseModel):
     role: str
     content: str
 
+# "compact": answer, references and log_id; "full": also every execution log
+Verbosity = Literal["compact", "full"]
+
 class ChatCompletionRequest(BaseModel):
     messages: List[Message]
     notebooks: Optional[List[str]] = []
+    # When set, the history summary is loaded from and saved to this chat
+    chat_id: Optional[int] = None
+    verbosity: Verbosity = "compact"
+
+class Reference(BaseModel):
+    notebook: str
+    query: Optional[str] = None
+    via: str  # "prefetch" or the tool name
 
 class ChatCompletionResponse(BaseModel):
     response: str
+    references: List[Reference] = []
+    # Full execution logs, from GET /api/chat/logs/{log_id}
+    log_id: Optional[str] = None
     prefetch_content: Optional[Dict[str, Any]] = None
     tool_calls: Optional[List[Dict[str, Any]]] = None
+    budget: Optional[Dict[str, Any]] = None
+    history: Optional[Dict[str, Any]] = None
+    answer_cache: Optional[Dict[str, Any]] = None
+    dedup: Optional[Dict[str, Any]] = None
+    model_routing: Optional[List[Dict[str, Any]]] = None
+
+
+def _compact_events(emit):
+    """Drops tool results from streamed events; they are in the stored execution logs."""
+    if emit is None:
+        return None
+
+    def compact_emit(event: str, data: dict):
+        if event == "tool_result":
+            data = {"id": data["id"]}
+        emit(event, data)
+
+    return compact_emit
+
+
+def _build_response(new_messages: list[dict], execution_logs: dict, verbosity: str = "compact") -> ChatCompletionResponse:
+    """
+    Stores the full execution logs and returns the response: with verbosity
+    "compact" only the answer, references and log id, with "full" everything.
+    """
+    # Extract the assistant's response
+    assistant_response = ""
+    if new_messages and new_messages[-1]["role"] == "assistant":
+        assistant_response = new_messages[-1]["content"]
+
+    # Extract prefetch content from logs
+    prefetch_content = execution_logs.get("prefetch", {})
 
-@router.post("/completion", response_model=ChatCompletionResponse)
-async def chat_completion(request: ChatCompletionRequest):
+    # Extract tool calls from main_llm logs
+    tool_calls = []
+    main_llm_logs = execution_logs.get("main_llm", [])
+    for log in main_llm_logs:
+        if "tool_calls" in log:
+            tool_calls.extend(log["tool_calls"])
+
+    references = ai_wrapper.answer_references(execution_logs)
+    full = ChatCompletionResponse(
+        response=assistant_response,
+        references=references,
+        prefetch_content=prefetch_content,
+        tool_calls=tool_calls,
+        budget=execution_logs.get("budget"),
+        history=execution_logs.get("history"),
+        answer_cache=execution_logs.get("answer_cache"),
+        dedup=execution_logs.get("dedup"),
+        model_routing=execution_logs.get("model_routing")
+    )
+    log_id = execution_log_store.save(full.model_dump(mode="json", exclude={"log_id"}))
+    if verbosity == "full":
+        full.log_id = log_id
+        return full
+    return ChatCompletionResponse(response=assistant_response, references=references, log_id=log_id)
+
+
+def _client_id(http_request: Request) -> str:
+    """
+    Who the request is for, for admission and OpenAI scheduling: the peer
+    address, or the admission_client_header value when one is configured
+    (only behind a proxy that sets it).
+    """
+    if settings.admission_client_header:
+        client_id = http_request.headers.get(settings.admission_client_header)
+        if client_id:
+            return client_id
+    return http_request.client.host if http_request.client else "unknown"
+
+
+@contextmanager
+def _admitted(http_request: Request):
+    """
+    Holds an admission slot for the block, waiting for one if needed; raises
+    429 with Retry-After when the request isn't admitted.
+    """
+    if not settings.admission_control:
+        yield
+        return
+    client_id = _client_id(http_request)
+    try:
+        ticket = admission_controller.acquire(client_id)
+    except AdmissionRejected as e:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=f"Too many concurrent completions ({e.reason}), retry later",
+            headers={"Retry-After": str(e.retry_after)}
+        )
+    try:
+        yield
+    finally:
+        admission_controller.release(client_id, ticket)
+
+
+def _idempotent(http_request: Request, body: BaseModel, response_cls, run, on_admitted=None):
+    """
+    Runs `run()` at most once per Idempotency-Key header value, when one is sent:
+    duplicates join the running request or get its stored response.
+    Only a request that actually runs takes an admission slot (calling
+    `on_admitted` once it has one); replays and joined duplicates don't.
+    Returns the response and whether it was replayed.
+    """
+    def admitted_run():
+        with _admitted(http_request), scheduling_client(_client_id(http_request)):
+            if on_admitted:
+                on_admitted()
+            return run()
+
+    key = http_request.headers.get("Idempotency-Key")
+    if not key:
+        return admitted_run(), False
+    scope = idempotency_scope(f"{http_request.method} {http_request.url.path}", key)
+    request_hash = hashlib.sha256(body.model_dump_json().encode("utf-8")).hexdigest()
+    try:
+        data, replayed = idempotency_store.run(scope, request_hash, lambda: admitted_run().model_dump(mode="json"))
+    except IdempotencyKeyMismatch:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="Idempotency-Key was already used with a different request"
+        )
+    except IdempotencyConflict:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="A request with this Idempotency-Key is still in progress"
+        )
+    return response_cls.model_validate(data), replayed
+
+
+def run_completion(request: ChatCompletionRequest, emit=None, cache_mode: str = "use") -> ChatCompletionResponse:
+    """
+    Runs the full chat pipeline for a request and builds the response.
+    `emit` is forwarded to execute_chat for progress events.
+    """
+    # Convert Pydantic models to dicts for the service
+    messages_dict = [msg.model_dump() for msg in request.messages]
+    print(messages_dict)
+    # We need to manage keywords for prefetch context, but since it's stateless,
+    # we'll start fresh or maybe we could accept them from frontend if we wanted persistence in session.
+    # For now, let's assume fresh keywords for each request or just pass empty list
+    # and let the service handle it (it updates the list in place).
+    keywords = []
+    budget = Budget.from_settings()
+
+    history_state = {}
+    if request.chat_id is not None:
+        with SessionLocal() as db:
+            history_state = ChatService.get_history_state(db, request.chat_id)
+        if history_state is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Chat with id {request.chat_id} not found"
+            )
+    history_count = history_state.get("count")
+
+    # Execute chat
+    # execute_chat returns (new_messages, execution_logs)
+    # new_messages includes the assistant response
+    # The static system prompt is added by execute_chat, drop any sent by the client
+    messages_dict = [msg for msg in messages_dict if msg["role"] != "system"]
+    if request.verbosity == "compact":
+        emit = _compact_events(emit)
+    new_messages, execution_logs = ai_wrapper.execute_chat(
+        messages_dict,
+        keywords,
+        request.notebooks,
+        emit,
+        budget,
+        None,  # summarized inside, after the answer cache lookup
+        history_state,
+        cache_mode
+    )
+
+    # Only write back when more turns were folded into the summary
+    if request.chat_id is not None and history_state.get("count") != history_count:
+        with SessionLocal() as db:
+            ChatService.save_history_state(db, request.chat_id, history_state)
+
+    return _build_response(new_messages, execution_logs, request.verbosity)
+
+
+@router.post("/completion", response_model=ChatCompletionResponse, response_model_exclude_none=True)
+def chat_completion(request: ChatCompletionRequest, http_request: Request, response: Response):
     """
     Stateless chat completion endpoint.
-    Takes a list of messages and returns the AI response along with prefetch content.
+    Takes a list of messages and returns the AI response with the notebooks it
+    drew on. Set `verbosity: "full"` to include prefetch content, tool calls and
+    the other execution logs; otherwise fetch them with GET /api/chat/logs/{log_id}.
+    First-turn answers may come from the semantic answer cache; send
+    `X-Answer-Cache: refresh|bypass` or `Cache-Control: no-cache|no-store` to skip it.
+    With an `Idempotency-Key` header, retries of the same request join or replay
+    the first one (marked with `Idempotent-Replayed: true`) instead of running again.
+    Returns 429 with Retry-After when too many completions are running or queued.
     """
     try:
-        # Convert Pydantic models to dicts for the service
-        messages_dict = [msg.model_dump() for msg in request.messages]
-        print(messages_dict)
-        # We need to manage keywords for prefetch context, but since it's stateless, 
-        # we'll start fresh or maybe we could accept them from frontend if we wanted persistence in session.
-        # For now, let's assume fresh keywords for each request or just pass empty list 
-        # and let the service handle it (it updates the list in place).
-        keywords = [] 
-        
-        # Execute chat
-        # execute_chat returns (new_messages, execution_logs)
-        # new_messages includes the assistant response
-        system = [{"role": "system", "content": MAIN_LLM_SYSTEM.format(notebook_summary = ai_wrapper.summarize_notebooks(request.notebooks))}]
-        new_messages, execution_logs = ai_wrapper.execute_chat(
-            system + messages_dict, 
-            keywords, 
-            request.notebooks
+        cache_mode = cache_mode_from_headers(http_request.headers)
+        result, replayed = _idempotent(
+            http_request, request, ChatCompletionResponse, lambda: run_completion(request, cache_mode=cache_mode)
         )
-        
-        # Extract the assistant's response
-        assistant_response = ""
-        if new_messages and new_messages[-1]["role"] == "assistant":
-            assistant_response = new_messages[-1]["content"]
-            
-        # Extract prefetch content from logs
-        prefetch_content = execution_logs.get("prefetch", {})
-        
-        # Extract tool calls from main_llm logs
-        tool_calls = []
-        main_llm_logs = execution_logs.get("main_llm", [])
-        for log in main_llm_logs:
-            if "tool_calls" in log:
-                tool_calls.extend(log["tool_calls"])
-        
-        return ChatCompletionResponse(
-            response=assistant_response,
-            prefetch_content=prefetch_content,
-            tool_calls=tool_calls
+        if replayed:
+            response.headers["Idempotent-Replayed"] = "true"
+        return result
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=str(e)
+        )
+
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+
+def _event_stream(run) -> StreamingResponse:
+    """
+    Runs `run(emit, on_admitted)` in a worker thread and streams its progress
+    events as SSE, finishing with a done event carrying the returned response
+    (or an error event). The stream starts once the worker is admitted or has
+    finished, so a request rejected before it runs (429 from admission, 422
+    and 409 from Idempotency-Key checks) gets a plain error response. The
+    worker keeps running, and holding its admission slot, if the client
+    disconnects.
+    """
+    events = queue.Queue()
+    ready = threading.Event()
+    rejected = []
+
+    def emit(event: str, data: dict):
+        events.put((event, data))
+
+    def worker():
+        try:
+            emit("done", run(emit, ready.set).model_dump(exclude_none=True))
+        except HTTPException as e:
+            if not ready.is_set():
+                rejected.append(e)
+            emit("error", {"detail": e.detail})
+        except Exception as e:
+            emit("error", {"detail": str(e)})
+        finally:
+            ready.set()
+            events.put(None)
+
+    threading.Thread(target=worker, daemon=True).start()
+    # Admission gives up after its queue timeout; a duplicate joining a running
+    # request only finishes with it, so its stream starts without waiting for that
+    ready.wait(settings.admission_queue_timeout_seconds + 1)
+    if rejected:
+        raise rejected[0]
+
+    def stream():
+        yield _sse("start", {})
+        while (item := events.get()) is not None:
+            yield _sse(*item)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.post("/completion/stream")
+def chat_completion_stream(request: ChatCompletionRequest, http_request: Request):
+    """
+    Streaming variant of /completion using Server-Sent Events.
+
+    Events: start, refined_query, prefetch (one per notebook, as it completes),
+    tool_call, tool_result (without the result unless verbosity is "full"),
+    token (answer deltas), then done with the same body as /completion, or error.
+    A request joining or replaying an earlier one with
+    the same `Idempotency-Key` only gets start and done. Like /completion,
+    returns 429 with Retry-After when too many completions are running or queued.
+    """
+    cache_mode = cache_mode_from_headers(http_request.headers)
+    return _event_stream(
+        lambda emit, on_admitted: _idempotent(
+            http_request, request, ChatCompletionResponse, lambda: run_completion(request, emit, cache_mode), on_admitted
+        )[0]
+    )
+
+
+@router.get("/logs/{log_id}")
+def get_execution_logs(log_id: str):
+    """
+    Full execution logs of a completion (the fields of a verbosity "full"
+    response), kept for a limited time after the request.
+    """
+    logs = execution_log_store.get(log_id)
+    if logs is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Execution logs {log_id} not found or expired"
         )
-        
+    return logs
+
+
+# Stateful completion: history, notebooks and per-chat state live in the database
+chats_router = APIRouter(prefix="/api/chats", tags=["chat"])
+
+
+class ChatTurnRequest(BaseModel):
+    content: str = Field(..., min_length=1, description="New user message")
+    verbosity: Verbosity = "compact"
+
+
+class ChatTurnResponse(ChatCompletionResponse):
+    user_message: MessageResponse
+    ai_message: MessageResponse
+
+
+def run_chat_turn(chat_id: int, request: ChatTurnRequest, emit=None, cache_mode: str = "use") -> ChatTurnResponse:
+    """
+    Runs one turn of a stored chat: loads the chat with its messages, runs the
+    pipeline with the chat's keywords, notebook summary and history summary,
+    then saves both messages and the updated state in one transaction.
+    """
+    with SessionLocal() as db:
+        chat = ChatService.get_chat_with_messages(db, chat_id)
+        if not chat:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Chat with id {chat_id} not found"
+            )
+        notebooks = list(chat.notebooks or [])
+        keywords = list(chat.keywords or [])
+        notebook_summary = chat.notebook_summary
+        history_state = {
+            "summary": chat.history_summary,
+            "count": chat.history_summary_count,
+            "prefix_hash": chat.history_summary_hash,
+        }
+        # Copied, so the JSON column sees a new value when it's saved
+        ledger_state = dict(chat.context_ledger or {})
+        messages = [
+            {"role": MESSAGE_ROLES[message.role], "content": message.content}
+            for message in chat.messages
+            if message.role in MESSAGE_ROLES
+        ]
+    messages.append({"role": "user", "content": request.content})
+
+    budget = Budget.from_settings()
+    if request.verbosity == "compact":
+        emit = _compact_events(emit)
+    new_messages, execution_logs = ai_wrapper.execute_chat(
+        messages,
+        keywords,
+        notebooks,
+        emit,
+        budget,
+        notebook_summary,
+        history_state,
+        cache_mode,
+        ledger_state
+    )
+    # Computed by execute_chat on the chat's first uncached turn
+    notebook_summary = execution_logs.get("notebook_summary", notebook_summary)
+    response = _build_response(new_messages, execution_logs, request.verbosity)
+
+    with SessionLocal() as db:
+        user_message, ai_message = ChatService.save_completion_turn(
+            db,
+            chat_id,
+            user_content=request.content,
+            ai_content=response.response,
+            keywords=keywords,
+            notebook_summary=notebook_summary,
+            history_state=history_state,
+            ledger_state=ledger_state,
+        )
+        return ChatTurnResponse(
+            **response.model_dump(),
+            user_message=MessageResponse.model_validate(user_message),
+            ai_message=MessageResponse.model_validate(ai_message),
+        )
+
+
+@chats_router.post("/{chat_id}/completion", response_model=ChatTurnResponse, response_model_exclude_none=True)
+def chat_turn_completion(chat_id: int, request: ChatTurnRequest, http_request: Request, response: Response):
+    """
+    Stateful chat completion. Takes only the new user message; history and
+    notebooks are loaded from the chat, and the user and assistant messages
+    are stored before returning. Supports `Idempotency-Key` like
+    /api/chat/completion, so a retried turn isn't stored twice.
+    """
+    try:
+        cache_mode = cache_mode_from_headers(http_request.headers)
+        result, replayed = _idempotent(
+            http_request, request, ChatTurnResponse, lambda: run_chat_turn(chat_id, request, cache_mode=cache_mode)
+        )
+        if replayed:
+            response.headers["Idempotent-Replayed"] = "true"
+        return result
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=str(e)
         )
+
+
+@chats_router.post("/{chat_id}/completion/stream")
+def chat_turn_completion_stream(chat_id: int, request: ChatTurnRequest, http_request: Request):
+    """Streaming variant of /{chat_id}/completion, with the same events as /api/chat/completion/stream."""
+    cache_mode = cache_mode_from_headers(http_request.headers)
+    return _event_stream(
+        lambda emit, on_admitted: _idempotent(
+            http_request, request, ChatTurnResponse, lambda: run_chat_turn(chat_id, request, emit, cache_mode), on_admitted
+        )[0]
+    )
@@ -0,0 +1,21 @@
+from fastapi import APIRouter
+from services.metrics import metrics
+from services.model_router import model_router
+
+router = APIRouter(prefix="/api/metrics", tags=["metrics"])
+
+
+@router.get("/")
+def get_metrics():
+    """
+    Get process-wide pipeline counters (cache hit rates, saved latency, etc.).
+    """
+    return metrics.snapshot()
+
+
+@router.get("/models")
+def get_model_stats():
+    """
+    Get the model router's recent latency and error rate per stage and model.
+    """
+    return model_router.snapshot()
@@ -0,0 +1,135 @@
+import json
+import time
+from config import settings
+from services.rag import rag_service
+from services.ai_wrapper import prefetch
+
+# Small notebooks on unrelated topics, created next to discrete_math so routing
+# has to choose between more notebooks than routing_top_k
+corpus = {
+    "routing_test_biology": (
+        "Photosynthesis converts light energy into chemical energy. In the light-dependent reactions, "
+        "chlorophyll in the thylakoid membranes absorbs light and splits water, releasing oxygen and "
+        "producing ATP and NADPH. The Calvin cycle in the stroma uses ATP and NADPH to fix carbon dioxide "
+        "into glucose.\n\n"
+        "Mitosis divides one eukaryotic cell into two genetically identical daughter cells. Its phases are "
+        "prophase, metaphase, anaphase and telophase, followed by cytokinesis. Meiosis produces four haploid "
+        "gametes and includes crossing over between homologous chromosomes.\n\n"
+        "Enzymes are proteins that lower the activation energy of reactions. Their activity depends on "
+        "temperature and pH, and competitive inhibitors bind the active site."
+    ),
+    "routing_test_history": (
+        "The French Revolution began in 1789 with the meeting of the Estates-General and the storming of "
+        "the Bastille. It abolished feudal privileges, issued the Declaration of the Rights of Man and of the "
+        "Citizen, and ended with the rise of Napoleon Bonaparte in 1799.\n\n"
+        "The Industrial Revolution started in Britain in the late eighteenth century. The steam engine "
+        "improved by James Watt, mechanized textile mills and railways transformed production, transport "
+        "and the growth of cities.\n\n"
+        "The Treaty of Versailles of 1919 ended the First World War. Germany lost territory, had to pay "
+        "reparations and accepted the war guilt clause."
+    ),
+    "routing_test_cooking": (
+        "A roux is cooked flour and fat used to thicken sauces. A white roux is the base of bechamel, a blond "
+        "roux of veloute, and a brown roux of espagnole.\n\n"
+        "Bread dough rises because yeast ferments sugars into carbon dioxide and alcohol. Kneading develops "
+        "gluten, which traps the gas; proofing at a warm temperature speeds up fermentation.\n\n"
+        "The Maillard reaction between amino acids and reducing sugars browns seared meat and toasted bread "
+        "at temperatures above about 140 degrees Celsius."
+    ),
+    "routing_test_astronomy": (
+        "A main sequence star fuses hydrogen into helium in its core. Stars much more massive than the Sun "
+        "end as supernovae and leave neutron stars or black holes, while Sun-like stars become white dwarfs.\n\n"
+        "Kepler's laws describe planetary orbits: orbits are ellipses with the Sun at one focus, a planet "
+        "sweeps equal areas in equal times, and the square of the orbital period is proportional to the "
+        "cube of the semi-major axis.\n\n"
+        "The cosmic microwave background is the thermal radiation left over from the early universe, about "
+        "380,000 years after the Big Bang."
+    ),
+}
+
+# (question, notebook that should answer it)
+fixtures = [
+    ("What is a tautology, and how is it different from a contradiction?", "discrete_math"),
+    ("Describe the main steps of Dijkstra's algorithm for finding the shortest path in a weighted graph.", "discrete_math"),
+    ("What is a Hamming code, and how is the redundancy of a code calculated?", "discrete_math"),
+    ("What happens in the Calvin cycle of photosynthesis?", "routing_test_biology"),
+    ("How does meiosis differ from mitosis?", "routing_test_biology"),
+    ("Why did the storming of the Bastille matter for the French Revolution?", "routing_test_history"),
+    ("What did Germany have to accept under the Treaty of Versailles?", "routing_test_history"),
+    ("Which sauces are based on a white, blond or brown roux?", "routing_test_cooking"),
+    ("Why does bread dough rise?", "routing_test_cooking"),
+    ("State Kepler's third law of planetary motion.", "routing_test_astronomy"),
+    ("What remains after a massive star explodes as a supernova?", "routing_test_astronomy"),
+]
+
+
+def timed_prefetch(question: str, notebooks: list[str]):
+    start = time.perf_counter()
+    _, logs = prefetch(question, [], notebooks)
+    return time.perf_counter() - start, logs
+
+
+def create_corpus():
+    for notebook, text in corpus.items():
+        rag_service.create_notebook(notebook)
+        rag_service.insert_data(notebook, text, source=f"{notebook}.txt")
+
+
+def run_tests():
+    create_corpus()
+    notebooks = ["discrete_math", *corpus]
+    for notebook in notebooks:
+        rag_service.rebuild_routing(notebook)
+
+    # Both arms run the same questions, the second one must not be served by the prefetch memo
+    settings.prefetch_memo = False
+    # Routing is skipped when there are no more notebooks than routing_top_k
+    routing_top_k = min(settings.routing_top_k or 1, len(notebooks) - 1)
+    results = []
+
+    try:
+        for question, expected in fixtures:
+            print(f"Running routing test for: {question}")
+
+            settings.routing_top_k = 0
+            fanout_time, _ = timed_prefetch(question, notebooks)
+
+            settings.routing_top_k = routing_top_k
+            routed_time, logs = timed_prefetch(question, notebooks)
+
+            selected = logs["routing"]["selected"]
+            results.append({
+                "question": question,
+                "expected": expected,
+                "selected": selected,
+                "scores": logs["routing"]["scores"],
+                "fallback": logs["routing"]["fallback"],
+                "correct": expected in selected,
+                "top1": bool(selected) and selected[0] == expected,
+                "fanout_seconds": round(fanout_time, 2),
+                "routed_seconds": round(routed_time, 2),
+            })
+    finally:
+        for notebook in corpus:
+            rag_service.delete_notebook(notebook)
+
+    accuracy = sum(r["correct"] for r in results) / len(results)
+    top1_accuracy = sum(r["top1"] for r in results) / len(results)
+    saved = sum(r["fanout_seconds"] - r["routed_seconds"] for r in results) / len(results)
+    report = {
+        "notebooks": notebooks,
+        "routing_top_k": routing_top_k,
+        "accuracy": accuracy,
+        "top1_accuracy": top1_accuracy,
+        "avg_latency_saved_seconds": round(saved, 2),
+        "results": results,
+    }
+
+    with open("routing_test_results.json", "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+
+    print(f"Routing accuracy: {accuracy:.0%} (top-1 {top1_accuracy:.0%}), avg prefetch latency saved: {saved:.2f}s")
+    print("Results saved to routing_test_results.json")
+
+if __name__ == "__main__":
+    run_tests()
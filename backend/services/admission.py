@@ -0,0 +1,117 @@
+import itertools
+import math
+import threading
+import time
+from collections import defaultdict, deque
+from config import settings
+from services.metrics import metrics
+
+# Weight of the newest request in the average pipeline duration
+EWMA_ALPHA = 0.2
+
+
+class AdmissionRejected(Exception):
+    """The request wasn't admitted; retry after `retry_after` seconds."""
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Limits how many completion pipelines run at once.
+
+    At most `max_concurrent` requests run; each client may have at most
+    `max_per_client` running or queued. Requests beyond the global limit wait
+    in a FIFO queue of at most `max_queue` for up to `queue_timeout_seconds`.
+    Requests over a limit, with a full queue, or still queued at the timeout
+    are rejected with a Retry-After estimate based on the average duration of
+    recent requests.
+    """
+
+    def __init__(self, max_concurrent: int, max_per_client: int, max_queue: int, queue_timeout_seconds: float):
+        self.max_concurrent = max_concurrent
+        self.max_per_client = max_per_client
+        self.max_queue = max_queue
+        self.queue_timeout_seconds = queue_timeout_seconds
+        self._cond = threading.Condition()
+        self._queue = deque()
+        self._in_flight = 0
+        self._per_client = defaultdict(int)
+        self._started = {}
+        self._seq = itertools.count()
+        self._avg_seconds = 10.0
+
+    def _retry_after(self) -> int:
+        # Roughly how long until the work ahead of a new request has drained
+        waves = (len(self._queue) + self._in_flight) / max(self.max_concurrent, 1)
+        return max(1, math.ceil(self._avg_seconds * max(waves, 1)))
+
+    def _reject(self, reason: str):
+        metrics.incr(f"admission_rejected:{reason}")
+        raise AdmissionRejected(reason, self._retry_after())
+
+    def _update_gauges(self):
+        metrics.set("admission_in_flight", self._in_flight)
+        metrics.set("admission_queued", len(self._queue))
+
+    def acquire(self, client_id: str) -> int:
+        """Blocks until the request may run and returns its ticket for release(); raises AdmissionRejected."""
+        start = time.monotonic()
+        with self._cond:
+            # .get, so rejected clients don't leave an entry behind
+            if self._per_client.get(client_id, 0) >= self.max_per_client:
+                self._reject("client_limit")
+            ticket = next(self._seq)
+            if self._in_flight >= self.max_concurrent or self._queue:
+                if len(self._queue) >= self.max_queue:
+                    self._reject("queue_full")
+                self._per_client[client_id] += 1
+                self._queue.append(ticket)
+                self._update_gauges()
+                deadline = start + self.queue_timeout_seconds
+                while self._queue[0] != ticket or self._in_flight >= self.max_concurrent:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._queue.remove(ticket)
+                        self._release_client(client_id)
+                        self._update_gauges()
+                        # The next in line may be able to go now
+                        self._cond.notify_all()
+                        self._reject("queue_timeout")
+                    self._cond.wait(remaining)
+                self._queue.popleft()
+            else:
+                self._per_client[client_id] += 1
+            self._in_flight += 1
+            self._started[ticket] = time.monotonic()
+            self._update_gauges()
+            self._cond.notify_all()
+
+        metrics.incr("admission_admitted")
+        metrics.incr("admission_wait_seconds", time.monotonic() - start)
+        return ticket
+
+    def _release_client(self, client_id: str):
+        self._per_client[client_id] -= 1
+        if not self._per_client[client_id]:
+            del self._per_client[client_id]
+
+    def release(self, client_id: str, ticket: int):
+        with self._cond:
+            duration = time.monotonic() - self._started.pop(ticket)
+            self._avg_seconds += EWMA_ALPHA * (duration - self._avg_seconds)
+            self._in_flight -= 1
+            self._release_client(client_id)
+            self._update_gauges()
+            self._cond.notify_all()
+
+
+admission_controller = AdmissionController(
+    max_concurrent=settings.admission_max_concurrent,
+    max_per_client=settings.admission_max_per_client,
+    max_queue=settings.admission_max_queue,
+    queue_timeout_seconds=settings.admission_queue_timeout_seconds,
+)
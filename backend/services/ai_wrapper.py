@@ -1,29 +1,114 @@
-from services.openai_service import client
+from services.openai_service import client, stage_timeout, hedged, in_current_context
+from services.model_router import model_router
 from services.rag import rag_service
+from services.context_packer import count_tokens, pack_passages
+from services.budget import Budget, cached_tokens
+from services.metrics import metrics
+from services.history import compact_history
+from services.answer_cache import answer_cache
+from services.prefetch_memo import prefetch_memo
+from services.context_ledger import ContextLedger
+from services.single_flight import SingleFlight
 from services.prompts import (
+    MAIN_LLM_SYSTEM,
     MAIN_LLM_USER,
     PRE_FETCH_LLM,
     PRE_FETCH_LLM_USER,
+    PRE_FETCH_LLM_BATCH_USER,
+    PRE_FETCH_LLM_BATCH_NOTEBOOK,
     SUMMARY_MODEL_PROMT,
     SEARCH_QUERY_OPTIMIZER,
     SEARCH_QUERY_OPTIMIZER_USER,
 )
+from config import settings
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
 import json
 import json_repair
-import tiktoken
+import numpy as np
+import time
 
-MAIN_MODEL = "gpt-4o"
-PREFETCH_MODEL = "gpt-3.5-turbo"
+# Concurrent identical calls (e.g. a class opening the same chat setup) share one in-flight call;
+# only the caller that made the call records its usage in its budget
+summary_flight = SingleFlight("notebook_summary")
+refine_flight = SingleFlight("refine_query")
+retrieve_flight = SingleFlight("retrieve")
+extract_flight = SingleFlight("prefetch_extract")
+extract_batch_flight = SingleFlight("prefetch_extract_batch")
+
+# Part of the prefetch memo key: changes whenever the extraction prompts or model routes do
+PREFETCH_PROMPT_VERSION = hashlib.sha256(
+    "\n".join([
+        PRE_FETCH_LLM,
+        PRE_FETCH_LLM_USER,
+        PRE_FETCH_LLM_BATCH_USER,
+        json.dumps([settings.llm_routes["prefetch"], settings.llm_routes["prefetch_batch"]]),
+    ]).encode("utf-8")
+).hexdigest()[:16]
+
+
+def _pack_tool_results(results: list[dict], ledger: ContextLedger | None) -> str:
+    """Packs search results for a tool response; chunks already in the ledger become references."""
+    if ledger is None:
+        return pack_passages(results, settings.tool_context_tokens)[0]
+    new, seen = ledger.split(results)
+    context, _ = pack_passages(new, settings.tool_context_tokens, label=ledger.label)
+    references = [ledger.reference(passage) for passage in seen]
+    return "\n\n".join(block for block in [context, *references] if block)
 
 
 def search_data(notebook: str, query: str, count: int = 8):
+    """
+    Searches one notebook. Returns an error message, or a render(ledger)
+    callback that packs the results into the tool response.
+    """
     print(f"\n\n**MAIN LLM SEARCH QUERY**: ({notebook}) {query}")
-    res = []
     try:
-        res.append(json.dumps(rag_service.search_data(notebook, query, count)))
-        return json.dumps({"result": res})
+        entry = rag_service.search_many([notebook], [query], count)[0]
     except Exception as e:
         return json.dumps({"error": str(e)})
+    if "error" in entry:
+        return json.dumps({"error": entry["error"]})
+
+    def render(ledger: ContextLedger | None) -> str:
+        context = _pack_tool_results(entry["results"], ledger)
+        if not context:
+            return f'No results in "{notebook}" for "{query}".'
+        return f'Results from "{notebook}" for "{query}":\n{context}'
+
+    return render
+
+
+def search_data_batch(searches: list[dict], count: int = 8):
+    """
+    Runs several {notebook, query} searches with one embeddings call and one
+    batched Qdrant request per notebook, grouped into a single tool response.
+    Returns an error message or a render(ledger) callback, like search_data.
+    """
+    print(f"\n\n**MAIN LLM BATCH SEARCH**: {searches}")
+    if not searches:
+        return "No searches were given, add at least one {notebook, query} pair."
+    try:
+        entries = rag_service.search_many(
+            [search["notebook"] for search in searches],
+            [search["query"] for search in searches],
+            count,
+        )
+    except Exception as e:
+        return json.dumps({"error": str(e)})
+
+    def render(ledger: ContextLedger | None) -> str:
+        blocks = []
+        for entry in entries:
+            header = f'### "{entry["notebook"]}" / "{entry["query"]}"'
+            if "error" in entry:
+                blocks.append(f"{header}\nError: {entry['error']}")
+                continue
+            context = _pack_tool_results(entry["results"], ledger)
+            blocks.append(f"{header}\n{context or 'No results.'}")
+        return "\n\n".join(blocks)
+
+    return render
 
 
 tools_schema = {
@@ -51,7 +136,310 @@ tools_schema = {
 }
 
 
-def prefetch(query: str, keywords: list[str], notebooks: list[str]):
+batch_tools_schema = {
+    "type": "function",
+    "function": {
+        "name": "search_data_batch",
+        "description": "Run several searches in the RAG database at once. Prefer it over repeated search_data calls whenever more than one query is needed.",
+        "strict": True,
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "searches": {
+                    "type": "array",
+                    "description": "Independent searches to run together",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "notebook": {
+                                "type": "string",
+                                "description": "Name of notebook where to execute query. Only use names provided in notebook_summary"
+                            },
+                            "query": {
+                                "type": "string",
+                                "description": "The query to search for data in the RAG database. Select them based on missing knowledge"
+                            }
+                        },
+                        "required": ["notebook", "query"],
+                        "additionalProperties": False,
+                    },
+                }
+            },
+            "required": ["searches"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+
+def filter_by_score(searches: list[dict]) -> list[dict]:
+    """
+    Drops hits below the absolute threshold or below the relative threshold
+    (a fraction of the best score across all notebooks of this turn).
+    """
+    scores = [hit["score"] for search in searches for hit in search["results"]]
+    best = max(scores, default=0.0)
+    threshold = max(settings.prefetch_min_score, best * settings.prefetch_relative_score)
+    # New dicts: the searches may be shared with coalesced requests
+    return [
+        {
+            **search,
+            "top_score": max((hit["score"] for hit in search["results"]), default=None),
+            "results": [hit for hit in search["results"] if hit["score"] >= threshold],
+        }
+        for search in searches
+    ]
+
+
+def route_notebooks(query_vector: list[float], notebooks: list[str]):
+    """
+    Picks the notebooks worth prefetching for the query using the centroid index.
+    Routing is among the notebooks that have a centroid; ones without (not yet
+    indexed, see rag_service.rebuild_routing) are always searched.
+    Returns the selected notebooks and a log entry with scores and timing.
+    """
+    start = time.perf_counter()
+    log = {"selected": list(notebooks), "scores": {}, "fallback": False}
+    top_k = settings.routing_top_k
+    if top_k <= 0 or len(notebooks) <= top_k or not query_vector:
+        return list(notebooks), log
+
+    try:
+        scores = rag_service.route_notebooks(query_vector, notebooks)
+    except Exception as e:
+        print(f"Error routing notebooks: {e}")
+        scores = {}
+    log["scores"] = scores
+
+    ranked = sorted(
+        (notebook for notebook in scores if scores[notebook] >= settings.routing_min_score),
+        key=lambda notebook: scores[notebook],
+        reverse=True,
+    )
+    unindexed = [notebook for notebook in notebooks if notebook not in scores]
+    log["unindexed"] = unindexed
+    if settings.routing_fallback_all and not ranked:
+        log["fallback"] = True
+        selected = list(notebooks)
+    else:
+        selected = ranked[:top_k] + unindexed
+
+    log["selected"] = selected
+    log["latency_ms"] = round((time.perf_counter() - start) * 1000, 1)
+    return selected, log
+
+
+def _no_emit(event: str, data: dict):
+    pass
+
+
+def _skipped_notebook(search: dict):
+    # Nothing relevant in this notebook - no extraction call is made
+    notebook_log = {
+        "notebook": search["notebook"],
+        "status": "skipped",
+        "top_score": search["top_score"],
+        "rag_data_count": 0
+    }
+    if "error" in search:
+        notebook_log["search_error"] = search["error"]
+    return {"notebook": search["notebook"], "data": {"score": "BAD", "extracted_facts": []}}, notebook_log, None
+
+
+def _extract_notebook(query: str, search: dict, budget: Budget):
+    """
+    Runs the prefetch-stage extraction over one notebook's search results.
+    Returns the output entry, the notebook log and the suggested keywords (or None).
+    """
+    if not search["results"]:
+        return _skipped_notebook(search)
+    key = (query, search["notebook"], tuple(hit["id"] for hit in search["results"]))
+    return extract_flight.do(key, _extract_notebook_call, query, search, budget)
+
+
+def _extract_notebook_call(query: str, search: dict, budget: Budget):
+    notebook = search["notebook"]
+    rag_data = search["results"]
+
+    context, pack_log = pack_passages(rag_data, settings.prefetch_context_tokens)
+    messages = [
+        {"role": "system", "content": PRE_FETCH_LLM},
+        {
+            "role": "user",
+            "content": PRE_FETCH_LLM_USER.format(
+                user_query=query, result=context
+            ),
+        },
+    ]
+    prompt_tokens = sum(count_tokens(message["content"]) for message in messages)
+    try:
+        model, response = model_router.call(
+            "prefetch",
+            lambda model: client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=0,
+                max_completion_tokens=budget.remaining_output_tokens(),
+                timeout=stage_timeout("prefetch", budget),
+            ),
+            prompt_tokens,
+            budget,
+        )
+    except Exception as e:
+        # A slow or failed extraction shouldn't sink the whole answer
+        print(f"Error extracting prefetch data: {e}")
+        notebook_log = {"notebook": notebook, "status": "error", "error": str(e), "context": pack_log}
+        return {"notebook": notebook, "data": {"score": "ERROR", "extracted_facts": []}}, notebook_log, None
+    budget.record(model, response.usage)
+    content = response.choices[0].message.content
+    
+    notebook_log = {
+        "notebook": notebook,
+        "model": model,
+        "raw_response": content,
+        "top_score": search["top_score"],
+        "rag_data_count": len(rag_data),
+        "context": pack_log
+    }
+    
+    notebook_log["input_tokens"] = response.usage.prompt_tokens
+    notebook_log["cached_tokens"] = cached_tokens(response.usage)
+    notebook_log["output_tokens"] = response.usage.completion_tokens
+    
+    try:
+        res = json_repair.loads(content)
+        suggested_keywords = res.pop("suggested_search_keywords", [])
+        notebook_log["parsed_data"] = res
+        notebook_log["status"] = "success"
+        return {"notebook": notebook, "data": res}, notebook_log, suggested_keywords
+    except Exception as e:
+        print(f"Error parsing response: {e}")
+        notebook_log["status"] = "error"
+        notebook_log["error"] = str(e)
+        return {"notebook": notebook, "data": {"score": "ERROR", "extracted_facts": []}}, notebook_log, None
+
+
+prefetch_batch_schema = {
+    "type": "object",
+    "properties": {
+        "notebooks": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "notebook": {"type": "string"},
+                    "score": {"type": "string", "enum": ["BAD", "PARTIAL", "GOOD"]},
+                    "extracted_facts": {"type": "array", "items": {"type": "string"}},
+                    "reasoning": {"type": "string"},
+                    "suggested_search_keywords": {"type": "array", "items": {"type": "string"}},
+                },
+                "required": ["notebook", "score", "extracted_facts", "reasoning", "suggested_search_keywords"],
+                "additionalProperties": False,
+            },
+        }
+    },
+    "required": ["notebooks"],
+    "additionalProperties": False,
+}
+
+
+def _extract_batch(query: str, searches: list[dict], budget: Budget):
+    """
+    Extracts facts for all notebooks with one structured-output call.
+    Returns per-search results like _extract_notebook and the batch log, or
+    None instead of the results when the packed prompt exceeds
+    prefetch_batch_max_tokens or the call fails (callers fall back to per-notebook calls).
+    """
+    key = (query, tuple((search["notebook"], tuple(hit["id"] for hit in search["results"])) for search in searches))
+    return extract_batch_flight.do(key, _extract_batch_call, query, searches, budget)
+
+
+def _extract_batch_call(query: str, searches: list[dict], budget: Budget):
+    blocks = []
+    pack_logs = {}
+    for search in searches:
+        if search["results"]:
+            context, pack_logs[search["notebook"]] = pack_passages(
+                search["results"], settings.prefetch_context_tokens
+            )
+            blocks.append(PRE_FETCH_LLM_BATCH_NOTEBOOK.format(notebook=search["notebook"], result=context))
+
+    messages = [
+        {"role": "system", "content": PRE_FETCH_LLM},
+        {
+            "role": "user",
+            "content": PRE_FETCH_LLM_BATCH_USER.format(user_query=query, notebooks="\n".join(blocks)),
+        },
+    ]
+    prompt_tokens = sum(count_tokens(message["content"]) for message in messages)
+    batch_log = {"prompt_tokens_estimate": prompt_tokens, "notebooks": len(blocks)}
+    if prompt_tokens > settings.prefetch_batch_max_tokens:
+        batch_log["status"] = "fallback_too_large"
+        return None, batch_log
+
+    try:
+        model, response = model_router.call(
+            "prefetch_batch",
+            lambda model: client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=0,
+                response_format={
+                    "type": "json_schema",
+                    "json_schema": {"name": "prefetch_extraction", "strict": True, "schema": prefetch_batch_schema},
+                },
+                max_completion_tokens=budget.remaining_output_tokens(),
+                timeout=stage_timeout("prefetch", budget),
+            ),
+            prompt_tokens,
+            budget,
+        )
+        budget.record(model, response.usage)
+        parsed = {item["notebook"]: item for item in json.loads(response.choices[0].message.content)["notebooks"]}
+    except Exception as e:
+        print(f"Error in batched prefetch extraction: {e}")
+        batch_log["status"] = "fallback_error"
+        batch_log["error"] = str(e)
+        return None, batch_log
+
+    batch_log["status"] = "success"
+    batch_log["model"] = model
+    batch_log["input_tokens"] = response.usage.prompt_tokens
+    batch_log["cached_tokens"] = cached_tokens(response.usage)
+    batch_log["output_tokens"] = response.usage.completion_tokens
+
+    results = []
+    for search in searches:
+        notebook = search["notebook"]
+        if not search["results"]:
+            results.append(_skipped_notebook(search))
+            continue
+        notebook_log = {
+            "notebook": notebook,
+            "top_score": search["top_score"],
+            "rag_data_count": len(search["results"]),
+            "context": pack_logs[notebook],
+            "batched": True,
+        }
+        item = parsed.get(notebook)
+        if item is None:
+            notebook_log["status"] = "error"
+            notebook_log["error"] = "Notebook missing from batched response"
+            results.append(({"notebook": notebook, "data": {"score": "ERROR", "extracted_facts": []}}, notebook_log, None))
+            continue
+        suggested_keywords = item.pop("suggested_search_keywords")
+        item.pop("notebook")
+        notebook_log["parsed_data"] = item
+        notebook_log["status"] = "success"
+        results.append(({"notebook": notebook, "data": item}, notebook_log, suggested_keywords))
+    return results, batch_log
+
+
+def _refine_query(query: str, keywords: list[str], budget: Budget) -> str:
+    return refine_flight.do((query, tuple(keywords)), _refine_query_call, query, keywords, budget)
+
+
+def _refine_query_call(query: str, keywords: list[str], budget: Budget) -> str:
     refinement_messages = [
         {"role": "system", "content": SEARCH_QUERY_OPTIMIZER},
         {
@@ -64,101 +452,509 @@ def prefetch(query: str, keywords: list[str], notebooks: list[str]):
     ]
     
     try:
-        refinement_response = client.chat.completions.create(
-            model=PREFETCH_MODEL, 
-            messages=refinement_messages, 
-            temperature=0
+        # Small and on the critical path: a slow call gets a hedged duplicate
+        model, refinement_response = model_router.call(
+            "refine",
+            lambda model: hedged(
+                "refine",
+                client.chat.completions.create,
+                model=model,
+                messages=refinement_messages,
+                temperature=0,
+                timeout=stage_timeout("refine", budget)
+            ),
+            sum(count_tokens(message["content"]) for message in refinement_messages),
+            budget,
         )
+        budget.record(model, refinement_response.usage)
         refined_query = refinement_response.choices[0].message.content.strip()
         print(f"Refined Query: {refined_query}")
+        return refined_query
     except Exception as e:
         print(f"Error refining query: {e}")
-        refined_query = query
+        return query
+
+
+def _retrieve(query: str, notebooks: list[str], query_vectors: list[list[float]] | None = None):
+    """
+    Embeds (unless vectors are given), routes and searches the query.
+    Returns the query vectors, the routing log and the search results.
+    """
+    # The vectors are derived from the query, so they don't need to be part of the key
+    return retrieve_flight.do((query, tuple(notebooks)), _retrieve_call, query, notebooks, query_vectors)
+
+
+def _retrieve_call(query: str, notebooks: list[str], query_vectors: list[list[float]] | None = None):
+    start = time.perf_counter()
+    if query_vectors is None:
+        query_vectors = rag_service.embed_queries([query])
+    selected, routing_log = route_notebooks(query_vectors[0] if query_vectors else [], notebooks)
+    searches = rag_service.search_many(selected, [query], 10, query_vectors=query_vectors or None)
+    return query_vectors, routing_log, searches, time.perf_counter() - start
+
+
+def _cosine(a: list[float], b: list[float]) -> float:
+    a, b = np.asarray(a), np.asarray(b)
+    return float(a @ b / (np.linalg.norm(a) * np.linalg.norm(b) + 1e-12))
+
+
+def prefetch_retrieve(query: str, keywords: list[str], notebooks: list[str], emit=None, budget: Budget | None = None) -> dict:
+    """
+    First half of prefetch: refines the query and retrieves candidates for it
+    (speculatively, in parallel with the refinement, when enabled).
+    Notebooks with a memoized prefetch for the refined query are not searched.
+    Returns the refined query, its embedding, the retrieval result, the
+    speculation log, the notebook versions and the memo hits.
+    """
+    emit = emit or _no_emit
+    budget = budget or Budget.from_settings()
+
+    speculation = None
+    speculative_log = None
+    if settings.speculative_retrieval and notebooks:
+        # Start retrieval with the raw query while the refinement call runs
+        speculation = ThreadPoolExecutor(max_workers=1)
+        speculative_future = speculation.submit(in_current_context(_retrieve), query, notebooks)
+
+    refined_query = _refine_query(query, keywords, budget)
+    emit("refined_query", {"query": refined_query})
+
+    versions = None
+    memo_hits = {}
+    if settings.prefetch_memo or settings.answer_cache:
+        versions = rag_service.notebook_versions(notebooks)
+    if settings.prefetch_memo and versions is not None:
+        memo_hits = prefetch_memo.get_many(notebooks, versions, refined_query, PREFETCH_PROMPT_VERSION)
+    # Memoized notebooks need neither search nor extraction
+    pending = [notebook for notebook in notebooks if notebook not in memo_hits]
+
+    retrieved = None
+    refined_vectors = None
+    if speculation:
+        wait_start = time.perf_counter()
+        try:
+            speculative = speculative_future.result()
+        except Exception as e:
+            print(f"Error in speculative retrieval: {e}")
+            speculative = None
+        finally:
+            speculation.shutdown(wait=False)
+        waited = time.perf_counter() - wait_start
+
+        speculative_log = {"hit": False, "similarity": None}
+        if speculative is not None and speculative[0]:
+            if refined_query == query:
+                similarity = 1.0
+                refined_vectors = speculative[0]
+            else:
+                refined_vectors = rag_service.embed_queries([refined_query])
+                similarity = _cosine(speculative[0][0], refined_vectors[0]) if refined_vectors else 0.0
+            speculative_log["similarity"] = round(similarity, 4)
+
+            if similarity >= settings.speculative_min_similarity:
+                retrieved = speculative
+                speculative_log["hit"] = True
+                # Retrieval time hidden behind the refinement call
+                speculative_log["latency_saved_ms"] = round(max(speculative[3] - waited, 0) * 1000, 1)
+                metrics.incr("speculative_retrieval_hits")
+                metrics.incr("speculative_retrieval_latency_saved_ms", speculative_log["latency_saved_ms"])
+            elif refined_vectors:
+                retrieved = _retrieve(refined_query, pending, refined_vectors)
+        metrics.incr("speculative_retrieval_attempts")
+
+    if retrieved is None and not pending and not settings.answer_cache:
+        # Everything is memoized and nothing needs the query embedding
+        retrieved = ([], {"selected": [], "scores": {}, "fallback": False}, [], 0.0)
+    if retrieved is None:
+        retrieved = _retrieve(refined_query, pending)
+    if not refined_vectors:
+        refined_vectors = retrieved[0]
+
+    return {
+        "refined_query": refined_query,
+        "query_vector": refined_vectors[0] if refined_vectors else None,
+        "retrieved": retrieved,
+        "speculative": speculative_log,
+        "versions": versions,
+        "memo_hits": memo_hits,
+    }
+
+
+def prefetch(
+    query: str,
+    keywords: list[str],
+    notebooks: list[str],
+    emit=None,
+    budget: Budget | None = None,
+    retrieval: dict | None = None,
+):
+    """
+    Refines the query, retrieves and extracts facts per notebook.
+    `retrieval` is a prefetch_retrieve result when the caller already ran the first half.
+    """
+    emit = emit or _no_emit
+    budget = budget or Budget.from_settings()
+
+    if retrieval is None:
+        retrieval = prefetch_retrieve(query, keywords, notebooks, emit, budget)
+    refined_query = retrieval["refined_query"]
+    speculative_log = retrieval["speculative"]
+    _, routing_log, searches, _ = retrieval["retrieved"]
+    memo_hits = retrieval["memo_hits"]
 
     logs = {
         "refined_query": refined_query,
-        "notebooks": []
+        "routing": routing_log,
+        "speculative": speculative_log,
+        "notebooks": [],
+        "prefetch_calls_avoided": 0,
+        "memo_hits": len(memo_hits),
     }
 
     output = []
-    for notebook in notebooks:
-        rag_data = rag_service.search_data(notebook, refined_query, 10)
-        messages = [
-            {"role": "system", "content": PRE_FETCH_LLM},
-            {
-                "role": "user",
-                "content": PRE_FETCH_LLM_USER.format(
-                    user_query=query, result=json.dumps(rag_data)
-                ),
-            },
-        ]
-        response = client.chat.completions.create(
-            model=PREFETCH_MODEL, messages=messages, temperature=0
-        )
-        content = response.choices[0].message.content
-        
+    # A speculative search may include notebooks that were memoized meanwhile
+    searches = filter_by_score([search for search in searches if search["notebook"] not in memo_hits])
+
+    results = None
+    if settings.prefetch_batched_extraction and sum(1 for search in searches if search["results"]) > 1:
+        results, logs["batch"] = _extract_batch(query, searches, budget)
+        for entry, notebook_log, _ in results or []:
+            emit("prefetch", {**entry, "status": notebook_log["status"]})
+
+    if results is None:
+        # Extraction calls are independent per notebook, run them side by side
+        results = [None] * len(searches)
+        with ThreadPoolExecutor(max_workers=max(len(searches), 1)) as executor:
+            futures = {
+                executor.submit(in_current_context(_extract_notebook), query, search, budget): index
+                for index, search in enumerate(searches)
+            }
+            for future in as_completed(futures):
+                entry, notebook_log, suggested_keywords = results[futures[future]] = future.result()
+                emit("prefetch", {**entry, "status": notebook_log["status"]})
+
+    versions = retrieval["versions"]
+    for (entry, notebook_log, suggested_keywords), search in zip(results, searches):
+        # Errors are retried next time, everything else is reusable until the notebook changes
+        if settings.prefetch_memo and versions is not None and notebook_log["status"] in ("success", "skipped"):
+            prefetch_memo.set(
+                entry["notebook"],
+                versions.get(entry["notebook"]),
+                refined_query,
+                PREFETCH_PROMPT_VERSION,
+                {"entry": entry, "suggested_keywords": suggested_keywords, "top_score": search["top_score"]},
+            )
+
+    for notebook, memoized in memo_hits.items():
         notebook_log = {
             "notebook": notebook,
-            "raw_response": content,
-            "rag_data_count": len(rag_data)
+            "status": "memo",
+            "score": memoized["entry"]["data"].get("score"),
+            "top_score": memoized["top_score"],
         }
-        
-        notebook_log["input_tokens"] = response.usage.prompt_tokens
-        notebook_log["output_tokens"] = response.usage.completion_tokens
-        
-        try:
-            res = json_repair.loads(content)
-            response_data = res.get("suggested_search_keywords", [])
-            keywords[:] = response_data
-            if "suggested_search_keywords" in res:
-                res.pop("suggested_search_keywords")
-            
-            output.append({"notebook": notebook, "data": res})
-            notebook_log["parsed_data"] = res
-            notebook_log["status"] = "success"
-        except Exception as e:
-            print(f"Error parsing response: {e}")
-            output.append(
-                {"notebook": notebook, "data": {"score": "ERROR", "extracted_facts": []}}
-            )
-            notebook_log["status"] = "error"
-            notebook_log["error"] = str(e)
-            
+        results.append((memoized["entry"], notebook_log, memoized["suggested_keywords"]))
+        emit("prefetch", {**memoized["entry"], "status": "memo"})
+
+    for entry, notebook_log, suggested_keywords in results:
+        output.append(entry)
         logs["notebooks"].append(notebook_log)
-            
+        if suggested_keywords is not None:
+            keywords[:] = suggested_keywords
+        if notebook_log["status"] in ("skipped", "memo"):
+            logs["prefetch_calls_avoided"] += 1
+
+    logs["context_tokens"] = sum(n.get("context", {}).get("tokens", 0) for n in logs["notebooks"])
     return output, logs
 
-def summarize_notebooks(notebooks: list[str]):
+def _summarize_notebook(notebook: str, budget: Budget | None = None) -> str:
+    rag_data = rag_service.scroll_notebook(notebook, 5);
+    messages = [{"role" : "system", "content": SUMMARY_MODEL_PROMT}, {"role" : "user", "content": json.dumps(rag_data)}]
+    model, response = model_router.call(
+        "summary",
+        lambda model: client.chat.completions.create(
+            model=model, messages=messages, temperature=0, timeout=stage_timeout("summary", budget)
+        ),
+        sum(count_tokens(message["content"]) for message in messages),
+        budget,
+    )
+    if budget:
+        budget.record(model, response.usage)
+    return response.choices[0].message.content
+
+
+def summarize_notebooks(notebooks: list[str], budget: Budget | None = None):
     output = ""
     for notebook in notebooks:
-        rag_data = rag_service.scroll_notebook(notebook, 5);
-        response = client.chat.completions.create(
-            model=PREFETCH_MODEL, messages=[{"role" : "system", "content": SUMMARY_MODEL_PROMT}, {"role" : "user", "content": json.dumps(rag_data)}], temperature=0
-        )
-        output += f" - {notebook}: {response.choices[0].message.content}\n"
+        summary = summary_flight.do(notebook, _summarize_notebook, notebook, budget)
+        output += f" - {notebook}: {summary}\n"
     return output
 
 
-def execute_chat(messages: list[dict], keywords: list[str], notebooks: list[str]):
+def _complete_main(to_send: list, emit, budget: Budget, tool_choice: str = "auto", stage: str = "main"):
+    """
+    Streams one completion of the main model routed for `stage` ("main" or
+    "tool_rounds"), forwarding content deltas as "token" events.
+    Returns the assistant message as a dict (including any tool calls), the usage and the model.
+    """
+    prompt_tokens = sum(
+        count_tokens(message.get("content") or "") + count_tokens(json.dumps(message.get("tool_calls") or ""))
+        for message in to_send
+    )
+    model, stream = model_router.call(
+        stage,
+        lambda model: client.chat.completions.create(
+            model=model,
+            messages=to_send,
+            stream=True,
+            stream_options={"include_usage": True},
+            tools=main_tools(),
+            tool_choice=tool_choice,
+            # Only a forced final answer may use the reserve; a direct answer
+            # to an "auto" call is capped like a tool round
+            max_completion_tokens=budget.remaining_output_tokens(final=tool_choice == "none"),
+            timeout=stage_timeout("main", budget),
+        ),
+        prompt_tokens,
+        budget,
+    )
+    content = []
+    tool_calls = {}
+    usage = None
+    for chunk in stream:
+        if chunk.usage:
+            usage = chunk.usage
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+        if delta.content:
+            content.append(delta.content)
+            emit("token", {"content": delta.content})
+        for tool_call_delta in delta.tool_calls or []:
+            tool_call = tool_calls.setdefault(
+                tool_call_delta.index,
+                {"id": None, "type": "function", "function": {"name": "", "arguments": ""}},
+            )
+            if tool_call_delta.id:
+                tool_call["id"] = tool_call_delta.id
+            if tool_call_delta.function:
+                tool_call["function"]["name"] += tool_call_delta.function.name or ""
+                tool_call["function"]["arguments"] += tool_call_delta.function.arguments or ""
+
+    budget.record(model, usage)
+    message = {"role": "assistant", "content": "".join(content) or None}
+    if tool_calls:
+        message["tool_calls"] = [tool_calls[index] for index in sorted(tool_calls)]
+    return message, usage, model
+
+
+available_functions = {
+    "search_data": search_data,
+    "search_data_batch": search_data_batch,
+}
+
+# Arguments the model may pass to each tool; anything else (e.g. count) is dropped
+tool_arguments = {
+    schema["function"]["name"]: set(schema["function"]["parameters"]["properties"])
+    for schema in (tools_schema, batch_tools_schema)
+}
+
+
+def main_tools() -> list[dict]:
+    if settings.batch_search_tool:
+        return [tools_schema, batch_tools_schema]
+    return [tools_schema]
+
+
+def _run_tool_call(tool_call: dict, emit) -> dict:
+    """
+    Executes one tool call from the main model and returns its log entry. A
+    search's results are kept under "render" until _finish_tool_call packs them.
+    """
+    start = time.perf_counter()
+    function_name = tool_call["function"]["name"]
+    function_to_call = available_functions.get(function_name)
+
+    tool_call_log = {
+        "id": tool_call["id"],
+        "name": function_name,
+        "arguments": tool_call["function"]["arguments"],
+        "response": None
+    }
+    emit("tool_call", {key: tool_call_log[key] for key in ("id", "name", "arguments")})
+
+    if function_to_call:
+        try:
+            function_args = {
+                name: value
+                for name, value in json.loads(tool_call["function"]["arguments"]).items()
+                if name in tool_arguments[function_name]
+            }
+
+            function_response = function_to_call(**function_args)
+        except json.JSONDecodeError:
+            function_response = json.dumps({"error": "Invalid JSON arguments from model"})
+        except Exception as e:
+            function_response = json.dumps({"error": str(e)})
+    else:
+        function_response = json.dumps({"error": f"Unknown tool: {function_name}"})
+
+    if callable(function_response):
+        tool_call_log["render"] = function_response
+    else:
+        tool_call_log["response"] = function_response
+    tool_call_log["latency_ms"] = round((time.perf_counter() - start) * 1000, 1)
+    return tool_call_log
+
+
+def _finish_tool_call(tool_call_log: dict, emit, ledger: ContextLedger | None = None) -> dict:
+    """
+    Packs a tool call's search results into its response. Called one tool call
+    at a time in the model's order, so a chunk is sent in full in the first
+    tool message that has it and later ones refer back to it.
+    """
+    render = tool_call_log.pop("render", None)
+    if render is not None:
+        try:
+            tool_call_log["response"] = render(ledger)
+        except Exception as e:
+            tool_call_log["response"] = json.dumps({"error": str(e)})
+    tool_call_log["tokens"] = count_tokens(tool_call_log["response"])
+    emit("tool_result", {"id": tool_call_log["id"], "response": tool_call_log["response"]})
+    return tool_call_log
+
+
+def answer_references(execution_logs: dict) -> list[dict]:
+    """
+    Notebooks (and queries) the answer drew on: useful prefetch results and tool
+    searches, or for a cached answer the references stored with it.
+    """
+    references = list(execution_logs.get("answer_cache", {}).get("references", []))
+    prefetch_logs = execution_logs.get("prefetch", {})
+    for notebook_log in prefetch_logs.get("notebooks", []):
+        score = (notebook_log.get("parsed_data") or {}).get("score", notebook_log.get("score"))
+        if notebook_log.get("status") in ("success", "memo") and score != "BAD":
+            references.append(
+                {"notebook": notebook_log["notebook"], "query": prefetch_logs.get("refined_query"), "via": "prefetch"}
+            )
+    for turn in execution_logs.get("main_llm", []):
+        for tool_call in turn.get("tool_calls", []):
+            try:
+                arguments = json.loads(tool_call["arguments"])
+            except (TypeError, ValueError):
+                continue
+            if not isinstance(arguments, dict):
+                continue
+            for search in arguments.get("searches", [arguments]):
+                if isinstance(search, dict) and search.get("notebook"):
+                    references.append({"notebook": search["notebook"], "query": search.get("query"), "via": tool_call["name"]})
+
+    unique = []
+    for reference in references:
+        if reference not in unique:
+            unique.append(reference)
+    return unique
+
+
+def execute_chat(
+    messages: list[dict],
+    keywords: list[str],
+    notebooks: list[str],
+    emit=None,
+    budget: Budget | None = None,
+    notebook_summary: str | None = None,
+    history_state: dict | None = None,
+    cache_mode: str = "use",
+    ledger_state: dict | None = None,
+):
+    """
+    Runs prefetch and the main model tool loop for the last user message.
+
+    `messages` is the conversation without a system message. The prompt is
+    assembled cache-friendly: the static MAIN_LLM_SYSTEM and the history form a
+    byte-stable prefix, and everything per-request (notebook summary, prefetch
+    content, query) goes into the final user message. `notebook_summary` is
+    computed with summarize_notebooks when not given.
+    `history_state` is the chat's running history summary (see compact_history),
+    updated in place when older turns get folded into it.
+    `cache_mode` ("use", "refresh", "bypass") controls the semantic answer
+    cache, which only applies to first-turn questions.
+    `ledger_state` is the chat's ContextLedger state, updated in place with the
+    chunks delivered in this turn.
+
+    `emit(event, data)` is called as the pipeline progresses (refined_query,
+    prefetch, tool_call, tool_result, token) so callers can stream progress.
+    `budget` caps time, tool rounds, tokens and cost; once the next round
+    would exceed it, the main model is forced to answer with tool_choice="none".
+    """
+    emit = emit or _no_emit
+    budget = budget or Budget.from_settings()
     execution_logs = {
         "prefetch": {},
         "main_llm": []
     }
     new_messages = []
-    
-    prefetch_res, prefetch_logs = prefetch(messages[-1]["content"], keywords, notebooks)
+
+    retrieval = None
+    cache_scope = None
+    # With the prefetch model failing, answer from the tools alone instead of erroring
+    prefetch_available = model_router.available("prefetch")
+    if settings.answer_cache and cache_mode != "bypass" and len(messages) == 1 and notebooks and prefetch_available:
+        try:
+            retrieval = prefetch_retrieve(messages[-1]["content"], keywords, notebooks, emit, budget)
+        except Exception as e:
+            # prefetch() below retries it and degrades if it fails again
+            print(f"Error in prefetch retrieval: {e}")
+    if retrieval is not None:
+        versions = retrieval["versions"]
+        if versions is not None and retrieval["query_vector"] is not None:
+            cache_scope = answer_cache.scope(notebooks, versions, messages[-1]["content"])
+        execution_logs["answer_cache"] = {"mode": cache_mode, "hit": False}
+        if cache_scope is not None and cache_mode == "use":
+            hit = answer_cache.lookup(cache_scope, retrieval["query_vector"])
+            if hit:
+                # Cached answers skip extraction, the notebook summary and the tool loop
+                emit("token", {"content": hit["answer"]})
+                execution_logs["answer_cache"].update(
+                    hit=True,
+                    similarity=hit["similarity"],
+                    cached_refined_query=hit["refined_query"],
+                    references=hit["references"],
+                )
+                execution_logs["prefetch"] = {"refined_query": retrieval["refined_query"], "notebooks": []}
+                execution_logs["budget"] = budget.report()
+                execution_logs["model_routing"] = budget.model_decisions
+                new_messages.append({"role": "assistant", "content": hit["answer"]})
+                return new_messages, execution_logs
+
+    prefetch_res, prefetch_logs = [], {"skipped": "circuit_open"}
+    if prefetch_available:
+        try:
+            prefetch_res, prefetch_logs = prefetch(messages[-1]["content"], keywords, notebooks, emit, budget, retrieval)
+        except Exception as e:
+            print(f"Error in prefetch: {e}")
+            prefetch_logs = {"skipped": "error", "error": str(e)}
+    if "skipped" in prefetch_logs:
+        metrics.incr("prefetch_degraded")
     execution_logs["prefetch"] = prefetch_logs
     
-    encoding = tiktoken.get_encoding("cl100k_base")
-    execution_logs["prefetch_content_tokens"] = len(encoding.encode(str(prefetch_res)))
+    execution_logs["prefetch_content_tokens"] = count_tokens(str(prefetch_res))
     
-    system_message = messages[0]
-    history = messages[1:-1]
+    if notebook_summary is None:
+        try:
+            notebook_summary = execution_logs["notebook_summary"] = summarize_notebooks(notebooks, budget)
+        except Exception as e:
+            # Not stored, so the next turn tries again
+            print(f"Error summarizing notebooks: {e}")
+            notebook_summary = "".join(f" - {notebook}\n" for notebook in notebooks)
+
+    system_message = {"role": "system", "content": MAIN_LLM_SYSTEM}
+    history, execution_logs["history"] = compact_history(messages[:-1], history_state, budget)
     last_user_content = messages[-1]["content"]
 
     formatted_last_msg = {
         "role": "user",
         "content": MAIN_LLM_USER.format(
+            notebook_summary=notebook_summary,
             prefetch=prefetch_res,
             user=last_user_content,
         ),
@@ -167,88 +963,92 @@ def execute_chat(messages: list[dict], keywords: list[str], notebooks: list[str]
 
     to_send = [system_message] + history + [formatted_last_msg]
 
-    response = client.chat.completions.create(
-        model=MAIN_MODEL,
-        messages=to_send,
-        stream=False,
-        tools=[tools_schema],
-        tool_choice="auto",
-    )
+    ledger = None
+    if settings.context_dedup:
+        ledger = ContextLedger(ledger_state)
+        ledger.start_turn()
+
     execution_logs["tool_tokens"] = 0
-    encoding = tiktoken.get_encoding("cl100k_base")
-    
+    tool_choice = "auto"
+    if budget.output_exhausted():
+        # Prefetch and summaries used up everything but the final answer reserve
+        budget.forced_final_reason = "max_output_tokens"
+        tool_choice = "none"
+
     while True:
-        response_message = response.choices[0].message
-        tool_calls = response_message.tool_calls
+        stage = "tool_rounds" if budget.tool_rounds else "main"
+        response_message, usage, model = _complete_main(to_send, emit, budget, tool_choice, stage)
+        tool_calls = response_message.get("tool_calls")
 
         to_send.append(response_message)
         
         # Log the assistant's turn
         turn_log = {
             "role": "assistant",
-            "content": response_message.content,
+            "content": response_message["content"],
+            "model": model,
             "tool_calls": []
         }
+        if usage:
+            turn_log["input_tokens"] = usage.prompt_tokens
+            turn_log["cached_tokens"] = cached_tokens(usage)
+            turn_log["output_tokens"] = usage.completion_tokens
         
-        if not tool_calls:
+        if not tool_calls or tool_choice == "none":
             # No tool calls = final response
-            new_messages.append({"role": "assistant", "content": response_message.content})
+            new_messages.append({"role": "assistant", "content": response_message["content"]})
             execution_logs["main_llm"].append(turn_log)
+            execution_logs["budget"] = budget.report()
+            execution_logs["model_routing"] = budget.model_decisions
+            if ledger:
+                execution_logs["dedup"] = ledger.report()
+            # Answers cut short by the budget aren't worth reusing
+            if cache_scope is not None and response_message["content"] and budget.forced_final_reason is None:
+                answer_cache.store(
+                    cache_scope,
+                    retrieval["query_vector"],
+                    retrieval["refined_query"],
+                    response_message["content"],
+                    answer_references(execution_logs),
+                )
             return new_messages, execution_logs
 
         # Process tool calls
         print(f"Tool calls triggered: {len(tool_calls)}")
-        
-        available_functions = {
-            "search_data": search_data,
-        }
 
-        for tool_call in tool_calls:
-            function_name = tool_call.function.name
-            function_to_call = available_functions.get(function_name)
-            
-            tool_call_log = {
-                "id": tool_call.id,
-                "name": function_name,
-                "arguments": tool_call.function.arguments,
-                "response": None
-            }
-            
-            if function_to_call:
-                try:
-                    function_args = json.loads(tool_call.function.arguments)
-                    
-                    function_response = function_to_call(
-                        query=function_args.get("query"), 
-                        notebook=function_args.get("notebook")
-                    )
-                except json.JSONDecodeError:
-                    function_response = json.dumps({"error": "Invalid JSON arguments from model"})
-                except Exception as e:
-                    function_response = json.dumps({"error": str(e)})
-
-                tool_call_log["response"] = function_response
-                
-                to_send.append(
-                    {
-                        "tool_call_id": tool_call.id,
-                        "role": "tool",
-                        "name": function_name,
-                        "content": function_response,
-                    }
-                )
-            
+        # Tool calls of one turn are independent, their searches run side by side
+        tools_start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max(1, settings.tool_call_concurrency)) as executor:
+            tool_results = list(
+                executor.map(in_current_context(lambda tool_call: _run_tool_call(tool_call, emit)), tool_calls)
+            )
+
+        # executor.map keeps the original tool_call order; results are packed in
+        # that order, since dedup against the ledger depends on it
+        for tool_call, tool_call_log in zip(tool_calls, tool_results):
+            _finish_tool_call(tool_call_log, emit, ledger)
+            # Every tool call needs a matching tool message, or the next request is rejected
+            to_send.append(
+                {
+                    "tool_call_id": tool_call["id"],
+                    "role": "tool",
+                    "name": tool_call_log["name"],
+                    "content": tool_call_log["response"],
+                }
+            )
             turn_log["tool_calls"].append(tool_call_log)
-            execution_logs["tool_tokens"] += len(encoding.encode(function_response))
+            execution_logs["tool_tokens"] += tool_call_log["tokens"]
+        turn_log["tools_latency_ms"] = round((time.perf_counter() - tools_start) * 1000, 1)
 
         execution_logs["main_llm"].append(turn_log)
+        budget.tool_rounds += 1
 
-        # Call LLM again with tool results
-        response = client.chat.completions.create(
-            model=MAIN_MODEL,
-            messages=to_send,
-            stream=False,
-            tools=[tools_schema],
-            tool_choice="auto",
+        next_input_tokens = (usage.prompt_tokens if usage else 0) + sum(
+            tool_call_log["tokens"] for tool_call_log in tool_results
         )
-        # Loop continues to check if the new response has tool calls or is final
+        reason = budget.final_answer_reason(model, next_input_tokens)
+        if reason:
+            print(f"Budget exhausted ({reason}), forcing final answer")
+            budget.forced_final_reason = reason
+            tool_choice = "none"
+        # Loop continues with the tool results to check if the next response is final
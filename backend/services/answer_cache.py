@@ -0,0 +1,147 @@
+import threading
+import unicodedata
+import uuid
+import numpy as np
+from cachetools import TTLCache
+from config import settings
+from services.metrics import metrics
+
+# Cache modes: "use" looks up and stores, "refresh" skips the lookup but stores
+# the new answer, "bypass" does neither
+CACHE_MODES = ("use", "refresh", "bypass")
+
+# Phrases that switch the main prompt into deep analysis mode (MAIN_LLM_SYSTEM)
+DEEP_ANALYSIS_TRIGGERS = (
+    "detailed report",
+    "comprehensive analysis",
+    "deep dive",
+    "🔍",
+    "детальний звіт",
+    "детальний аналіз",
+    "комплексний аналіз",
+    "глибокий аналіз",
+)
+UKRAINIAN_LETTERS = set("іїєґ")
+RUSSIAN_LETTERS = set("ыэъё")
+
+
+def cache_mode_from_headers(headers) -> str:
+    """
+    Maps request headers to a cache mode. `X-Answer-Cache: use|refresh|bypass`
+    wins; otherwise `Cache-Control: no-store` bypasses and `no-cache` refreshes.
+    """
+    explicit = (headers.get("x-answer-cache") or "").strip().lower()
+    if explicit in CACHE_MODES:
+        return explicit
+    cache_control = (headers.get("cache-control") or "").lower()
+    if "no-store" in cache_control:
+        return "bypass"
+    if "no-cache" in cache_control:
+        return "refresh"
+    return "use"
+
+
+def query_language(query: str) -> str:
+    """
+    Rough language of the query from its letters: "uk" or "ru" for Cyrillic
+    with letters unique to either, otherwise the dominant script ("latin",
+    "cyrillic", "cjk"...). Answers are written in the query's language, so
+    queries in different scripts must not share cached answers.
+    """
+    letters = [char for char in query.lower() if char.isalpha()]
+    if not letters:
+        return "none"
+    if UKRAINIAN_LETTERS.intersection(letters):
+        return "uk"
+    if RUSSIAN_LETTERS.intersection(letters):
+        return "ru"
+    scripts = {}
+    for char in letters:
+        script = unicodedata.name(char, "UNKNOWN").split()[0].lower()
+        scripts[script] = scripts.get(script, 0) + 1
+    return max(scripts, key=scripts.get)
+
+
+def answer_shape(query: str) -> tuple:
+    """The parts of the raw query that shape the answer but not the refined query."""
+    lowered = query.lower()
+    deep = any(trigger in lowered for trigger in DEEP_ANALYSIS_TRIGGERS)
+    return (query_language(query), "deep" if deep else "quick")
+
+
+class AnswerCache:
+    """
+    Semantic cache of final answers for first-turn questions.
+
+    Entries are scoped by the sorted notebook set and their content versions,
+    so re-ingesting a notebook makes its old answers unreachable, and by the
+    answer shape of the raw query (language and deep analysis mode), which the
+    refined query drops. Within a scope, a stored answer is returned when the
+    cosine similarity between the refined-query embeddings is at least
+    `min_similarity`. Eviction is TTL + LRU.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float, min_similarity: float):
+        self.min_similarity = min_similarity
+        self._entries = TTLCache(maxsize=max_entries, ttl=ttl_seconds)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def scope(notebooks: list[str], versions: dict, query: str) -> tuple | None:
+        """The cache scope, or None when some notebook has no known version and can't be cached."""
+        notebook_versions = tuple((notebook, versions.get(notebook)) for notebook in sorted(set(notebooks)))
+        if any(version is None for _, version in notebook_versions):
+            return None
+        return notebook_versions, answer_shape(query)
+
+    def lookup(self, scope: tuple, query_vector: list[float]) -> dict | None:
+        """Returns the best matching entry ({"answer", "refined_query", "references", "similarity"}) or None."""
+        metrics.incr("answer_cache_lookups")
+        query = np.asarray(query_vector, dtype=np.float64)
+        query /= np.linalg.norm(query) + 1e-12
+
+        best_key, best_similarity = None, -1.0
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if entry["scope"] != scope:
+                    continue
+                similarity = float(entry["vector"] @ query)
+                if similarity > best_similarity:
+                    best_key, best_similarity = key, similarity
+            if best_key is None or best_similarity < self.min_similarity:
+                metrics.incr("answer_cache_misses")
+                return None
+            # Reading through the cache refreshes its LRU position
+            entry = self._entries[best_key]
+
+        metrics.incr("answer_cache_hits")
+        return {
+            "answer": entry["answer"],
+            "refined_query": entry["refined_query"],
+            "references": entry["references"],
+            "similarity": round(best_similarity, 4),
+        }
+
+    def store(self, scope: tuple, query_vector: list[float], refined_query: str, answer: str, references: list[dict]):
+        vector = np.asarray(query_vector, dtype=np.float64)
+        vector /= np.linalg.norm(vector) + 1e-12
+        with self._lock:
+            self._entries[uuid.uuid4().hex] = {
+                "scope": scope,
+                "vector": vector,
+                "refined_query": refined_query,
+                "answer": answer,
+                "references": references,
+            }
+        metrics.incr("answer_cache_stores")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+answer_cache = AnswerCache(
+    max_entries=settings.answer_cache_max_entries,
+    ttl_seconds=settings.answer_cache_ttl_seconds,
+    min_similarity=settings.answer_cache_min_similarity,
+)
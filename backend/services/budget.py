@@ -0,0 +1,153 @@
+import threading
+import time
+from config import settings
+from services.metrics import metrics
+
+# Prompt tokens served from OpenAI's prefix cache are billed at half price
+CACHED_INPUT_DISCOUNT = 0.5
+
+
+def model_prices(model: str) -> tuple[float, float]:
+    """USD per 1M tokens (input, output) from settings.llm_prices."""
+    prices = settings.llm_prices.get(model)
+    if prices is None:
+        # Routes can change at runtime; the startup check can't catch those
+        print(f"No price configured for {model}, its cost isn't counted")
+        return 0.0, 0.0
+    return prices[0], prices[1]
+
+
+def cached_tokens(usage) -> int:
+    """Prompt tokens served from the prefix cache, 0 when the API doesn't report them."""
+    details = getattr(usage, "prompt_tokens_details", None)
+    return (getattr(details, "cached_tokens", None) or 0) if details else 0
+
+
+class Budget:
+    """
+    Per-request limits for the chat pipeline: wall-clock deadline, tool rounds,
+    input/output tokens and cost. Every OpenAI call records its usage here and
+    takes its timeout from the remaining time; model routing decisions are
+    collected in model_decisions. `final_answer_output_tokens` of the output
+    budget are reserved for the final answer and not given to earlier stages.
+    """
+
+    def __init__(
+        self,
+        deadline_seconds: float,
+        max_tool_rounds: int,
+        max_input_tokens: int,
+        max_output_tokens: int,
+        max_cost: float,
+        final_answer_reserve_seconds: float,
+        final_answer_output_tokens: int = 0,
+    ):
+        self.started = time.monotonic()
+        self.deadline = self.started + deadline_seconds
+        self.max_tool_rounds = max_tool_rounds
+        self.max_input_tokens = max_input_tokens
+        self.max_output_tokens = max_output_tokens
+        self.max_cost = max_cost
+        self.final_answer_reserve_seconds = final_answer_reserve_seconds
+        self.final_answer_output_tokens = final_answer_output_tokens
+
+        self.tool_rounds = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.cached_tokens = 0
+        self.cost = 0.0
+        self.forced_final_reason = None
+        self.model_decisions = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls) -> "Budget":
+        return cls(
+            deadline_seconds=settings.budget_deadline_seconds,
+            max_tool_rounds=settings.budget_max_tool_rounds,
+            max_input_tokens=settings.budget_max_input_tokens,
+            max_output_tokens=settings.budget_max_output_tokens,
+            max_cost=settings.budget_max_cost,
+            final_answer_reserve_seconds=settings.budget_final_answer_reserve_seconds,
+            final_answer_output_tokens=settings.budget_final_answer_output_tokens,
+        )
+
+    def remaining_seconds(self) -> float:
+        return self.deadline - time.monotonic()
+
+    def timeout(self, min_seconds: float = 5.0) -> float:
+        """Timeout for the next OpenAI call, never below min_seconds."""
+        return max(self.remaining_seconds(), min_seconds)
+
+    def remaining_output_tokens(self, final: bool = False) -> int:
+        """
+        Output token cap for the next call. Calls before the final answer can't
+        dip into its reserve; the final answer always gets at least the reserve,
+        even when parallel stages overshot the budget.
+        """
+        left = self.max_output_tokens - self.output_tokens
+        if final:
+            return max(left, self.final_answer_output_tokens, 1)
+        return max(left - self.final_answer_output_tokens, 1)
+
+    def output_exhausted(self) -> bool:
+        """True once only the final answer reserve of the output budget is left."""
+        return self.output_tokens + self.final_answer_output_tokens >= self.max_output_tokens
+
+    def record(self, model: str, usage):
+        if usage is None:
+            return
+        input_price, output_price = model_prices(model)
+        cached = cached_tokens(usage)
+        cost = (
+            (usage.prompt_tokens - cached * CACHED_INPUT_DISCOUNT) * input_price
+            + usage.completion_tokens * output_price
+        ) / 1_000_000
+        # Prefetch records usage from several threads at once
+        with self._lock:
+            self.input_tokens += usage.prompt_tokens
+            self.output_tokens += usage.completion_tokens
+            self.cached_tokens += cached
+            self.cost += cost
+        metrics.incr("openai_calls")
+        metrics.incr("openai_prompt_tokens", usage.prompt_tokens)
+        metrics.incr("openai_cached_tokens", cached)
+        metrics.incr(f"openai_prompt_tokens:{model}", usage.prompt_tokens)
+        metrics.incr(f"openai_cached_tokens:{model}", cached)
+
+    def final_answer_reason(self, model: str, next_input_tokens: int) -> str | None:
+        """
+        Returns why the next main model call must be the final answer
+        (tool_choice="none"), or None while there is budget for another tool round.
+        """
+        input_price, _ = model_prices(model)
+        if self.tool_rounds >= self.max_tool_rounds:
+            return "max_tool_rounds"
+        if self.remaining_seconds() < self.final_answer_reserve_seconds:
+            return "deadline"
+        # Leave room for the final answer on top of the next tool round
+        if self.input_tokens + 2 * next_input_tokens > self.max_input_tokens:
+            return "max_input_tokens"
+        if self.output_exhausted():
+            return "max_output_tokens"
+        if self.cost + 2 * next_input_tokens * input_price / 1_000_000 > self.max_cost:
+            return "max_cost"
+        return None
+
+    def report(self) -> dict:
+        return {
+            "elapsed_seconds": round(time.monotonic() - self.started, 2),
+            "deadline_seconds": round(self.deadline - self.started, 2),
+            "tool_rounds": self.tool_rounds,
+            "max_tool_rounds": self.max_tool_rounds,
+            "input_tokens": self.input_tokens,
+            "max_input_tokens": self.max_input_tokens,
+            "cached_tokens": self.cached_tokens,
+            "cache_hit_rate": round(self.cached_tokens / self.input_tokens, 3) if self.input_tokens else 0.0,
+            "output_tokens": self.output_tokens,
+            "max_output_tokens": self.max_output_tokens,
+            "final_answer_output_tokens": self.final_answer_output_tokens,
+            "cost": round(self.cost, 5),
+            "max_cost": self.max_cost,
+            "forced_final_reason": self.forced_final_reason,
+        }
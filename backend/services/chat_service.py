@@ -1,7 +1,7 @@
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, joinedload
 from sqlalchemy import func
 from typing import List, Optional, Tuple
-from models import Chat
+from models import Chat, Message
 from schemas import ChatCreate, ChatUpdate, ChatResponse, ChatDetailResponse, PaginationParams
 from fastapi import HTTPException, status
 
@@ -34,7 +34,6 @@ class ChatService:
             return None
         
         # Get message count efficiently
-        from models import Message
         message_count = db.query(func.count(Message.id)).filter(
             Message.chat_id == chat_id
         ).scalar()
@@ -77,6 +76,11 @@ class ChatService:
         update_data = chat_data.model_dump(exclude_unset=True)
         for field, value in update_data.items():
             setattr(chat, field, value)
+        if "notebooks" in update_data:
+            # Summary and keywords were built for the old notebooks
+            chat.notebook_summary = None
+            chat.keywords = []
+            chat.context_ledger = None
         
         db.commit()
         db.refresh(chat)
@@ -93,6 +97,84 @@ class ChatService:
         db.commit()
         return True
     
+    @staticmethod
+    def get_history_state(db: Session, chat_id: int) -> Optional[dict]:
+        """Get the running history summary of a chat in the form used by compact_history."""
+        chat = db.query(Chat).filter(Chat.id == chat_id).first()
+        if not chat:
+            return None
+        return {
+            "summary": chat.history_summary,
+            "count": chat.history_summary_count,
+            "prefix_hash": chat.history_summary_hash,
+        }
+    
+    @staticmethod
+    def save_history_state(db: Session, chat_id: int, state: dict) -> bool:
+        """Persist the running history summary of a chat."""
+        chat = db.query(Chat).filter(Chat.id == chat_id).first()
+        if not chat:
+            return False
+        
+        chat.history_summary = state.get("summary")
+        chat.history_summary_count = state.get("count") or 0
+        chat.history_summary_hash = state.get("prefix_hash")
+        db.commit()
+        return True
+    
+    @staticmethod
+    def get_chat_with_messages(db: Session, chat_id: int) -> Optional[Chat]:
+        """Get a chat together with its messages in a single query."""
+        return (
+            db.query(Chat)
+            .options(joinedload(Chat.messages))
+            .filter(Chat.id == chat_id)
+            .first()
+        )
+    
+    @staticmethod
+    def save_completion_turn(
+        db: Session,
+        chat_id: int,
+        user_content: str,
+        ai_content: str,
+        keywords: List[str],
+        notebook_summary: Optional[str],
+        history_state: dict,
+        ledger_state: Optional[dict] = None
+    ) -> Tuple[Message, Message]:
+        """
+        Store the user and assistant messages of a completion turn and the
+        updated chat state in one transaction.
+        """
+        chat = db.query(Chat).filter(Chat.id == chat_id).with_for_update().first()
+        if not chat:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Chat with id {chat_id} not found"
+            )
+        
+        # now() is fixed for the whole transaction, clock_timestamp() keeps the
+        # two messages in order
+        user_message = Message(chat_id=chat_id, role="user", content=user_content, created_at=func.clock_timestamp())
+        db.add(user_message)
+        db.flush()
+        ai_message = Message(chat_id=chat_id, role="ai", content=ai_content or "", created_at=func.clock_timestamp())
+        db.add(ai_message)
+        
+        chat.keywords = keywords
+        chat.notebook_summary = notebook_summary
+        chat.history_summary = history_state.get("summary")
+        chat.history_summary_count = history_state.get("count") or 0
+        chat.history_summary_hash = history_state.get("prefix_hash")
+        if ledger_state is not None:
+            chat.context_ledger = ledger_state
+        
+        db.commit()
+        db.refresh(user_message)
+        db.refresh(ai_message)
+        return user_message, ai_message
+    
     @staticmethod
     def chat_exists(db: Session, chat_id: int) -> bool:
         """Check if a chat exists."""
@@ -0,0 +1,84 @@
+import threading
+from services.context_packer import count_tokens, format_passage
+
+
+class ContextLedger:
+    """
+    Per-chat record of the chunks (Qdrant point ids) delivered to the main model
+    in full during the current turn. Chunks seen again in the same turn are
+    replaced by a short reference to the label they were first sent under,
+    e.g. `[C4] (lecture_3.pdf) already provided above`.
+
+    Dedup only spans one turn: earlier turns' tool outputs are stripped from
+    the prompt, so a reference to them would point at text the model no longer
+    sees. Their entries are dropped when a turn starts and those chunks are
+    sent in full again; across turns the ledger only keeps labels unique.
+    Truncated passages are not recorded, their cut-off tail may still be needed.
+
+    The state dict ({"turn": int, "next_ref": int, "entries": {point_id: {"ref", "turn"}}})
+    is updated in place so callers can persist it with the chat; next_ref keeps
+    labels unique across turns, so [C<n>] cited in earlier answers stay unambiguous.
+    """
+
+    def __init__(self, state: dict | None = None):
+        self.state = state if state is not None else {}
+        self.state.setdefault("turn", 0)
+        self.state.setdefault("next_ref", 1)
+        self.state.setdefault("entries", {})
+        self.references = 0
+        self.saved_tokens = 0
+        self._lock = threading.Lock()
+
+    def start_turn(self):
+        with self._lock:
+            self.state["turn"] += 1
+            self.state["entries"] = {}
+            self.references = 0
+            self.saved_tokens = 0
+
+    @staticmethod
+    def _ids(passage: dict) -> list[str]:
+        return [str(point_id) for point_id in passage.get("ids") or [passage["id"]]]
+
+    def split(self, passages: list[dict]):
+        """Splits passages into new ones and ones whose chunks were all delivered in this turn."""
+        with self._lock:
+            entries = self.state["entries"]
+            new, seen = [], []
+            for passage in passages:
+                if all(point_id in entries for point_id in self._ids(passage)):
+                    seen.append(passage)
+                else:
+                    new.append(passage)
+            return new, seen
+
+    def label(self, passage: dict, number: int, truncated: bool = False) -> str:
+        """
+        pack_passages label callback: returns the passage's reference and, unless
+        it was truncated, records it as delivered.
+        """
+        with self._lock:
+            ref = f"C{self.state['next_ref']}"
+            self.state["next_ref"] += 1
+            if not truncated:
+                for point_id in self._ids(passage):
+                    self.state["entries"][point_id] = {"ref": ref, "turn": self.state["turn"]}
+            return ref
+
+    def reference(self, passage: dict) -> str:
+        """Short reference block for a passage delivered earlier in this turn; counts the tokens saved."""
+        with self._lock:
+            entry = self.state["entries"][self._ids(passage)[0]]
+            block = format_passage(entry["ref"], passage, "already provided above")
+            saved = count_tokens(format_passage(entry["ref"], passage)) - count_tokens(block)
+            self.references += 1
+            self.saved_tokens += max(saved, 0)
+            return block
+
+    def report(self) -> dict:
+        return {
+            "turn": self.state["turn"],
+            "references": self.references,
+            "saved_tokens": self.saved_tokens,
+            "ledger_size": len(self.state["entries"]),
+        }
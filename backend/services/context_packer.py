@@ -0,0 +1,70 @@
+from functools import lru_cache
+import tiktoken
+
+
+@lru_cache(maxsize=None)
+def get_encoding(name: str = "cl100k_base"):
+    """Loads a tiktoken encoder once per process."""
+    return tiktoken.get_encoding(name)
+
+
+def count_tokens(text: str) -> int:
+    return len(get_encoding().encode(text))
+
+
+def format_passage(number: int | str, passage: dict, text: str | None = None) -> str:
+    return f"[{number}] ({passage.get('source')}) {passage['text'] if text is None else text}"
+
+
+def pack_passages(passages: list[dict], budget: int, min_truncated_tokens: int = 50, label=None):
+    """
+    Greedily packs the highest-scoring passages into at most `budget` tokens.
+
+    Passages are rendered as compact `[n] (source) text` blocks. The first passage
+    that doesn't fit is truncated if at least `min_truncated_tokens` of room is left;
+    everything after that is dropped. `label(passage, n, truncated)` replaces the
+    number n for passages that end up packed (ContextLedger uses it to hand out
+    references and to record fully delivered passages).
+
+    Returns:
+        The packed context string and a log dict with the token count and what was
+        packed, truncated and dropped.
+    """
+    encoding = get_encoding()
+    ranked = sorted(passages, key=lambda p: p.get("score") or 0.0, reverse=True)
+    separator_tokens = len(encoding.encode("\n\n"))
+
+    blocks = []
+    used = 0
+    log = {"packed": 0, "truncated": 0, "dropped": 0}
+    for passage in ranked:
+        if used >= budget:
+            log["dropped"] += 1
+            continue
+
+        block = format_passage(len(blocks) + 1, passage)
+        tokens = len(encoding.encode(block)) + (separator_tokens if blocks else 0)
+        if used + tokens <= budget:
+            if label:
+                block = format_passage(label(passage, len(blocks) + 1), passage)
+            blocks.append(block)
+            used += tokens
+            log["packed"] += 1
+            continue
+
+        room = budget - used - (separator_tokens if blocks else 0)
+        header_tokens = len(encoding.encode(format_passage(len(blocks) + 1, passage, "")))
+        if room - header_tokens >= min_truncated_tokens:
+            text_tokens = encoding.encode(passage["text"])[: room - header_tokens]
+            number = label(passage, len(blocks) + 1, truncated=True) if label else len(blocks) + 1
+            block = format_passage(number, passage, encoding.decode(text_tokens) + "…")
+            blocks.append(block)
+            used = budget
+            log["truncated"] += 1
+        else:
+            log["dropped"] += 1
+
+    context = "\n\n".join(blocks)
+    log["tokens"] = count_tokens(context) if blocks else 0
+    log["budget"] = budget
+    return context, log
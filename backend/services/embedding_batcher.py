@@ -0,0 +1,90 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class EmbeddingBatcher:
+    """
+    Micro-batcher for query embeddings.
+
+    Concurrent embed() calls are collected for up to `window_ms` after the first
+    one arrives (or until `max_batch` texts are queued) and sent as a single
+    `embed_fn(texts)` call; the vectors are then handed back to each caller.
+    Duplicate texts within a batch are embedded once. Up to
+    `max_concurrent_batches` calls run at a time, so a slow call doesn't hold
+    back the next batch. A caller waits at most `timeout_seconds` for its vectors.
+    """
+
+    def __init__(
+        self,
+        embed_fn,
+        window_ms: float = 5.0,
+        max_batch: int = 64,
+        max_concurrent_batches: int = 4,
+        timeout_seconds: float = 30.0,
+    ):
+        self.embed_fn = embed_fn
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.timeout_seconds = timeout_seconds
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrent_batches, thread_name_prefix="embedding-batch")
+        self._queue = queue.Queue()
+        self._worker = None
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.requests = 0
+
+    def embed(self, texts: list[str], timeout: float | None = None) -> list[list[float]]:
+        """Vectors for texts; raises TimeoutError after `timeout` (default timeout_seconds)."""
+        if not texts:
+            return []
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((list(texts), future))
+        return future.result(timeout=timeout if timeout is not None else self.timeout_seconds)
+
+    def _ensure_worker(self):
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+                self._worker.start()
+
+    def _collect(self) -> list:
+        pending = [self._queue.get()]
+        size = len(pending[0][0])
+        deadline = time.monotonic() + self.window
+        while size < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            pending.append(item)
+            size += len(item[0])
+        return pending
+
+    def _run(self):
+        while True:
+            pending = self._collect()
+            self.batches += 1
+            self.requests += len(pending)
+            self._executor.submit(self._dispatch, pending)
+
+    def _dispatch(self, pending: list):
+        unique = list(dict.fromkeys(text for texts, _ in pending for text in texts))
+        try:
+            embeddings = self.embed_fn(unique)
+            if len(embeddings) != len(unique):
+                raise ValueError(f"Expected {len(unique)} embeddings, got {len(embeddings)}")
+            vectors = dict(zip(unique, embeddings))
+            results = [[vectors[text] for text in texts] for texts, _ in pending]
+        except BaseException as e:
+            # Every waiting caller must be woken up, whatever went wrong
+            for _, future in pending:
+                future.set_exception(e)
+            return
+        for (_, future), result in zip(pending, results):
+            future.set_result(result)
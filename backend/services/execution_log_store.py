@@ -0,0 +1,88 @@
+import json
+import threading
+import uuid
+from datetime import datetime, timedelta, timezone
+from cachetools import TTLCache
+from config import settings
+
+
+class ExecutionLogStore:
+    """
+    Keeps the full execution logs of completions for `ttl_seconds`, so compact
+    responses only need to carry the log id.
+
+    The in-process copy is bounded by `max_bytes` of serialized JSON (oldest
+    logs are evicted first; a single log larger than that isn't kept in
+    memory). It is per worker, so with several workers a log id is only found
+    by the worker that made it: multi-worker deployments need the Postgres
+    backend, where logs can be fetched from any worker. Its failures are logged
+    and the logs are then only kept in this process.
+    """
+
+    def __init__(self, max_bytes: int, ttl_seconds: float, backend: str = "memory"):
+        self.ttl_seconds = ttl_seconds
+        self.backend = backend
+        self._entries = TTLCache(maxsize=max_bytes, ttl=ttl_seconds, getsizeof=self._size)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _size(logs: dict) -> int:
+        return len(json.dumps(logs, ensure_ascii=False, default=str))
+
+    def save(self, logs: dict) -> str:
+        """Stores JSON-serializable logs and returns their id."""
+        log_id = uuid.uuid4().hex
+        with self._lock:
+            try:
+                self._entries[log_id] = logs
+            except ValueError:
+                print(f"Execution logs {log_id} exceed the in-memory limit, not kept in this process")
+        if self.backend == "postgres":
+            self._db_save(log_id, logs)
+        return log_id
+
+    def get(self, log_id: str) -> dict | None:
+        with self._lock:
+            logs = self._entries.get(log_id)
+        if logs is None and self.backend == "postgres":
+            logs = self._db_get(log_id)
+        return logs
+
+    def _db_save(self, log_id: str, logs: dict):
+        from database import SessionLocal
+        from models import ExecutionLog
+
+        try:
+            now = datetime.now(timezone.utc)
+            with SessionLocal() as db:
+                db.query(ExecutionLog).filter(
+                    ExecutionLog.created_at < now - timedelta(seconds=self.ttl_seconds)
+                ).delete(synchronize_session=False)
+                db.add(ExecutionLog(id=log_id, data=logs, created_at=now))
+                db.commit()
+        except Exception as e:
+            print(f"Error storing execution logs: {e}")
+
+    def _db_get(self, log_id: str) -> dict | None:
+        from database import SessionLocal
+        from models import ExecutionLog
+
+        try:
+            cutoff = datetime.now(timezone.utc) - timedelta(seconds=self.ttl_seconds)
+            with SessionLocal() as db:
+                row = (
+                    db.query(ExecutionLog)
+                    .filter(ExecutionLog.id == log_id, ExecutionLog.created_at >= cutoff)
+                    .first()
+                )
+                return row.data if row else None
+        except Exception as e:
+            print(f"Error reading execution logs: {e}")
+            return None
+
+
+execution_log_store = ExecutionLogStore(
+    max_bytes=settings.execution_log_max_bytes,
+    ttl_seconds=settings.execution_log_ttl_seconds,
+    backend=settings.execution_log_backend,
+)
@@ -0,0 +1,180 @@
+from collections import OrderedDict
+import hashlib
+import json
+import threading
+import time
+from config import settings
+from services.openai_service import client, stage_timeout
+from services.model_router import model_router
+from services.context_packer import count_tokens
+from services.budget import Budget
+from services.metrics import metrics
+from services.prompts import (
+    HISTORY_SUMMARY_PROMPT,
+    HISTORY_SUMMARY_USER,
+    HISTORY_SUMMARY_MESSAGE,
+)
+
+TOOL_OUTPUT_PLACEHOLDER = "[tool output omitted]"
+SUMMARY_CACHE_SIZE = 256
+
+# Summaries keyed by (previous summary, folded messages), so clients without a
+# persisted chat still summarize each prefix only once per process
+_summary_cache = OrderedDict()
+_summary_cache_lock = threading.Lock()
+
+
+def _split_turns(messages: list[dict]) -> list[list[dict]]:
+    """Groups messages into turns, each starting at a user message."""
+    turns = []
+    for message in messages:
+        if message["role"] == "user" or not turns:
+            turns.append([])
+        turns[-1].append(message)
+    return turns
+
+
+def _messages_tokens(messages: list[dict]) -> int:
+    return sum(count_tokens(message.get("content") or "") for message in messages)
+
+
+def strip_tool_outputs(turns: list[list[dict]]) -> list[dict]:
+    """
+    Flattens turns back into messages, replacing tool outputs of every turn but
+    the last with a placeholder (the tool messages stay so tool_call ids still match).
+    """
+    messages = []
+    for index, turn in enumerate(turns):
+        last = index == len(turns) - 1
+        for message in turn:
+            if message["role"] == "tool" and not last:
+                message = {**message, "content": TOOL_OUTPUT_PLACEHOLDER}
+            messages.append(message)
+    return messages
+
+
+def _prefix_hash(messages: list[dict]) -> str:
+    """Fingerprint of the summarized messages, to notice a history edited under the summary."""
+    return hashlib.sha256(
+        json.dumps([[message["role"], message.get("content")] for message in messages]).encode("utf-8")
+    ).hexdigest()
+
+
+def _render_for_summary(messages: list[dict]) -> str:
+    lines = []
+    for message in messages:
+        # Tool outputs are search dumps, the answers that used them are enough
+        if message["role"] == "tool" or not message.get("content"):
+            continue
+        lines.append(f"{message['role']}: {message['content']}")
+    return "\n\n".join(lines)
+
+
+def _summarize(summary: str, messages: list[dict], budget: Budget | None) -> str:
+    rendered = _render_for_summary(messages)
+    key = hashlib.sha256(json.dumps([summary, rendered]).encode("utf-8")).hexdigest()
+    with _summary_cache_lock:
+        if key in _summary_cache:
+            _summary_cache.move_to_end(key)
+            metrics.incr("history_summary_cache_hits")
+            return _summary_cache[key]
+
+    prompt = [
+        {"role": "system", "content": HISTORY_SUMMARY_PROMPT},
+        {
+            "role": "user",
+            "content": HISTORY_SUMMARY_USER.format(
+                summary=summary, messages=rendered, max_tokens=settings.history_summary_tokens
+            ),
+        },
+    ]
+    model, response = model_router.call(
+        "history_summary",
+        lambda model: client.chat.completions.create(
+            model=model,
+            messages=prompt,
+            temperature=0,
+            max_completion_tokens=(
+                min(settings.history_summary_tokens, budget.remaining_output_tokens())
+                if budget else settings.history_summary_tokens
+            ),
+            timeout=stage_timeout("summary", budget),
+        ),
+        sum(count_tokens(message["content"]) for message in prompt),
+        budget,
+    )
+    if budget:
+        budget.record(model, response.usage)
+    metrics.incr("history_summary_calls")
+    new_summary = response.choices[0].message.content.strip()
+
+    with _summary_cache_lock:
+        _summary_cache[key] = new_summary
+        if len(_summary_cache) > SUMMARY_CACHE_SIZE:
+            _summary_cache.popitem(last=False)
+    return new_summary
+
+
+def compact_history(history: list[dict], state: dict | None = None, budget: Budget | None = None):
+    """
+    Builds the history part of the main prompt.
+
+    `state` holds the running summary for a chat: {"summary": str, "count": int,
+    "prefix_hash": str}, where count is how many leading history messages the
+    summary covers and prefix_hash fingerprints them. It is updated in place when
+    more turns get folded, so callers can persist it.
+
+    Returns the messages to send (summary message first, if any, then the
+    verbatim turns with old tool outputs stripped) and a log dict.
+    """
+    state = state if state is not None else {}
+    log = {
+        "history_messages": len(history),
+        "original_tokens": _messages_tokens(history),
+    }
+    if not settings.history_compaction:
+        log["tokens"] = log["original_tokens"]
+        return history, log
+
+    summary = state.get("summary") or ""
+    # A stale summary (client sent a shorter or edited history) means start over
+    count = state.get("count") or 0
+    if not summary or count > len(history) or state.get("prefix_hash") != _prefix_hash(history[:count]):
+        if summary:
+            log["summary_reset"] = True
+        summary, count = "", 0
+
+    turns = _split_turns(history[count:])
+    fold = 0
+    if len(turns) > settings.history_keep_turns + settings.history_compact_batch_turns:
+        fold = len(turns) - settings.history_keep_turns
+    # Fold earlier if the verbatim turns alone are too long, always keeping the last one
+    while fold < len(turns) - 1 and _messages_tokens(strip_tool_outputs(turns[fold:])) > settings.history_max_tokens:
+        fold += 1
+
+    if fold:
+        folded = [message for turn in turns[:fold] for message in turn]
+        start = time.perf_counter()
+        try:
+            summary = _summarize(summary, folded, budget)
+            count += len(folded)
+            turns = turns[fold:]
+            state["summary"] = summary
+            state["count"] = count
+            state["prefix_hash"] = _prefix_hash(history[:count])
+            log["folded_messages"] = len(folded)
+        except Exception as e:
+            # Send the full history rather than failing the answer
+            print(f"Error summarizing history: {e}")
+            log["error"] = str(e)
+        log["summarize_latency_ms"] = round((time.perf_counter() - start) * 1000, 1)
+
+    messages = strip_tool_outputs(turns)
+    if summary:
+        messages = [{"role": "system", "content": HISTORY_SUMMARY_MESSAGE.format(summary=summary)}] + messages
+
+    log["summarized_messages"] = count
+    log["verbatim_messages"] = len(history) - count
+    log["summary_tokens"] = count_tokens(summary) if summary else 0
+    log["tokens"] = _messages_tokens(messages)
+    return messages, log
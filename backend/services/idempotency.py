@@ -0,0 +1,203 @@
+import hashlib
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+from datetime import datetime, timedelta, timezone
+from cachetools import TTLCache
+from config import settings
+from services.metrics import metrics
+
+IN_PROGRESS = "in_progress"
+COMPLETED = "completed"
+# How often a duplicate checks whether another worker finished the request
+POLL_SECONDS = 0.5
+
+
+class IdempotencyKeyMismatch(Exception):
+    """The key was already used with a different request body."""
+
+
+class IdempotencyConflict(Exception):
+    """The original request is still running after waiting for it."""
+
+
+def idempotency_scope(endpoint: str, key: str) -> str:
+    """Store key for a client Idempotency-Key, so the same key on two endpoints doesn't collide."""
+    return hashlib.sha256(f"{endpoint}\n{key}".encode("utf-8")).hexdigest()
+
+
+class IdempotencyStore:
+    """
+    Runs requests sent with an Idempotency-Key at most once per key.
+
+    A duplicate arriving while the original is running waits for it and gets
+    its response; one arriving later gets the stored response replayed until
+    `ttl_seconds` after completion. Failed requests aren't stored, so a retry
+    runs again.
+
+    Duplicates in the same process join the in-flight call directly. With the
+    Postgres backend the key is also claimed in the idempotency_keys table, so
+    duplicates handled by other workers poll it for the response. An in-progress
+    claim older than `wait_seconds` is treated as abandoned and taken over.
+    Postgres failures are logged and the request runs without cross-worker dedup.
+    """
+
+    def __init__(self, ttl_seconds: float, wait_seconds: float, max_entries: int, backend: str = "memory"):
+        self.ttl_seconds = ttl_seconds
+        self.wait_seconds = wait_seconds
+        self.backend = backend
+        self._completed = TTLCache(maxsize=max_entries, ttl=ttl_seconds)
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def run(self, key: str, request_hash: str, fn) -> tuple[dict, bool]:
+        """
+        Returns fn()'s JSON-serializable response and whether it was replayed
+        (joined or from the store) rather than produced by this call.
+        """
+        with self._lock:
+            stored = self._completed.get(key)
+            if stored is None:
+                inflight = self._inflight.get(key)
+                leader = inflight is None
+                if leader:
+                    inflight = self._inflight[key] = (request_hash, Future())
+
+        if stored is not None:
+            self._check_hash(stored[0], request_hash)
+            metrics.incr("idempotency_replays")
+            return stored[1], True
+
+        inflight_hash, future = inflight
+        if not leader:
+            self._check_hash(inflight_hash, request_hash)
+            metrics.incr("idempotency_joined")
+            try:
+                return future.result(timeout=self.wait_seconds), True
+            except TimeoutError:
+                raise IdempotencyConflict(key)
+
+        try:
+            if self.backend == "postgres":
+                response, replayed = self._run_shared(key, request_hash, fn)
+            else:
+                response, replayed = fn(), False
+            with self._lock:
+                self._completed[key] = (request_hash, response)
+            future.set_result(response)
+            return response, replayed
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+
+    @staticmethod
+    def _check_hash(stored_hash: str, request_hash: str):
+        if stored_hash != request_hash:
+            metrics.incr("idempotency_mismatches")
+            raise IdempotencyKeyMismatch()
+
+    def _run_shared(self, key: str, request_hash: str, fn) -> tuple[dict, bool]:
+        deadline = time.monotonic() + self.wait_seconds
+        while True:
+            try:
+                row = self._db_claim(key, request_hash)
+            except Exception as e:
+                print(f"Error claiming idempotency key: {e}")
+                return fn(), False
+            if row is None:
+                break
+            self._check_hash(row["request_hash"], request_hash)
+            if row["status"] == COMPLETED:
+                metrics.incr("idempotency_replays")
+                return row["response"], True
+            if time.monotonic() >= deadline:
+                raise IdempotencyConflict(key)
+            metrics.incr("idempotency_polls")
+            time.sleep(POLL_SECONDS)
+
+        try:
+            response = fn()
+        except BaseException:
+            self._db_release(key)
+            raise
+        self._db_complete(key, response)
+        return response, False
+
+    def _db_claim(self, key: str, request_hash: str) -> dict | None:
+        """Claims the key for this request. Returns None when claimed, else the existing record."""
+        from sqlalchemy import and_, or_
+        from sqlalchemy.dialects.postgresql import insert
+        from database import SessionLocal
+        from models import IdempotencyRecord
+
+        now = datetime.now(timezone.utc)
+        with SessionLocal() as db:
+            # Expired responses and abandoned claims don't block the key
+            db.query(IdempotencyRecord).filter(
+                IdempotencyRecord.key == key,
+                or_(
+                    and_(
+                        IdempotencyRecord.status == COMPLETED,
+                        IdempotencyRecord.completed_at < now - timedelta(seconds=self.ttl_seconds),
+                    ),
+                    and_(
+                        IdempotencyRecord.status == IN_PROGRESS,
+                        IdempotencyRecord.created_at < now - timedelta(seconds=self.wait_seconds),
+                    ),
+                ),
+            ).delete(synchronize_session=False)
+            claimed = db.execute(
+                insert(IdempotencyRecord)
+                .values(key=key, request_hash=request_hash, status=IN_PROGRESS, created_at=now)
+                .on_conflict_do_nothing(index_elements=["key"])
+                .returning(IdempotencyRecord.key)
+            ).first()
+            db.commit()
+            if claimed:
+                return None
+            record = db.get(IdempotencyRecord, key)
+            if record is None:
+                # Released between the insert and the read, try again on the next poll
+                return {"request_hash": request_hash, "status": IN_PROGRESS}
+            return {"request_hash": record.request_hash, "status": record.status, "response": record.response}
+
+    def _db_complete(self, key: str, response: dict):
+        from database import SessionLocal
+        from models import IdempotencyRecord
+
+        try:
+            now = datetime.now(timezone.utc)
+            with SessionLocal() as db:
+                db.query(IdempotencyRecord).filter(IdempotencyRecord.key == key).update(
+                    {"status": COMPLETED, "response": response, "completed_at": now}, synchronize_session=False
+                )
+                db.query(IdempotencyRecord).filter(
+                    IdempotencyRecord.completed_at < now - timedelta(seconds=self.ttl_seconds)
+                ).delete(synchronize_session=False)
+                db.commit()
+        except Exception as e:
+            print(f"Error storing idempotent response: {e}")
+
+    def _db_release(self, key: str):
+        from database import SessionLocal
+        from models import IdempotencyRecord
+
+        try:
+            with SessionLocal() as db:
+                db.query(IdempotencyRecord).filter(
+                    IdempotencyRecord.key == key, IdempotencyRecord.status == IN_PROGRESS
+                ).delete(synchronize_session=False)
+                db.commit()
+        except Exception as e:
+            print(f"Error releasing idempotency key: {e}")
+
+
+idempotency_store = IdempotencyStore(
+    ttl_seconds=settings.idempotency_ttl_seconds,
+    wait_seconds=settings.idempotency_wait_seconds,
+    max_entries=settings.idempotency_max_entries,
+    backend=settings.idempotency_backend,
+)
@@ -0,0 +1,28 @@
+import threading
+from collections import defaultdict
+
+
+class Metrics:
+    """
+    Process-wide counters and gauges for the chat pipeline, exposed via GET /api/metrics.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(float)
+
+    def incr(self, name: str, value: float = 1):
+        with self._lock:
+            self._counters[name] += value
+
+    def set(self, name: str, value: float):
+        """Sets a gauge, e.g. a queue depth."""
+        with self._lock:
+            self._counters[name] = value
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self._counters)
+
+
+metrics = Metrics()
@@ -0,0 +1,197 @@
+import threading
+import time
+import openai
+from config import settings
+from services.metrics import metrics
+from services.resilience import breaker
+
+# Weight of the newest call in the latency and error rate moving averages
+EWMA_ALPHA = 0.3
+# Routing stages whose calls use another stage's timeout (see stage_timeout)
+TIMEOUT_STAGES = {"prefetch_batch": "prefetch", "history_summary": "summary", "tool_rounds": "main"}
+
+
+def is_model_error(error: Exception) -> bool:
+    """Errors that say the model is unhealthy: connection errors, timeouts, 429 and 5xx."""
+    if isinstance(error, (openai.APIConnectionError, openai.RateLimitError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+
+class ModelRouter:
+    """
+    Picks the model for each pipeline stage from settings.llm_routes.
+
+    A stage's models are tried in order (primary first). A model is skipped
+    when it has no price in llm_prices, the prompt doesn't fit its
+    llm_max_prompt_tokens, its circuit breaker is open, or its recent error
+    rate or latency on this stage is above the limits (once it has
+    llm_min_samples calls). Stats older than llm_stats_ttl_seconds are ignored,
+    so a skipped model is tried again once they go stale. When every model is
+    skipped, the fastest one the prompt fits is used.
+
+    Only is_model_error() failures count against a model, and a timeout caused
+    by an almost spent request budget doesn't. Such a failure retries the call
+    on the next model of the route that the prompt fits.
+
+    Settings are read on every call, so routes can be changed at runtime.
+    """
+
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def _fresh_stats(self, stage: str, model: str) -> dict | None:
+        stats = self._stats.get((stage, model))
+        if stats and time.monotonic() - stats["updated"] <= settings.llm_stats_ttl_seconds:
+            return stats
+        return None
+
+    @staticmethod
+    def _fits(model: str, prompt_tokens: int) -> bool:
+        return prompt_tokens <= settings.llm_max_prompt_tokens.get(model, prompt_tokens)
+
+    def _skip_reason(self, stage: str, model: str, prompt_tokens: int) -> str | None:
+        if not self._fits(model, prompt_tokens):
+            return "prompt_too_large"
+        if breaker(model).is_open():
+            return "circuit_open"
+        stats = self._fresh_stats(stage, model)
+        if stats and stats["samples"] >= settings.llm_min_samples:
+            if stats["error_rate"] > settings.llm_max_error_rate:
+                return "error_rate"
+            target = settings.llm_latency_targets_ms.get(stage)
+            if target and stats["latency_ms"] is not None and stats["latency_ms"] > target:
+                return "latency"
+        return None
+
+    def choose(self, stage: str, prompt_tokens: int = 0, exclude: tuple = ()) -> dict:
+        """
+        Returns the routing decision: the model, why it was picked and what was
+        skipped. Models in `exclude` (already tried) aren't considered.
+        """
+        decision = {"stage": stage, "model": None, "reason": None, "prompt_tokens": prompt_tokens, "skipped": []}
+        models = []
+        for model in settings.llm_routes[stage]:
+            if model in exclude:
+                continue
+            if model not in settings.llm_prices:
+                # Its cost couldn't be counted against budget_max_cost
+                decision["skipped"].append({"model": model, "reason": "unpriced"})
+                continue
+            models.append(model)
+        if not models:
+            raise ValueError(f"No priced model left to route stage {stage}")
+        with self._lock:
+            for index, model in enumerate(models):
+                reason = self._skip_reason(stage, model, prompt_tokens)
+                if reason is None:
+                    decision["model"] = model
+                    decision["reason"] = "primary" if index == 0 and not exclude else "fallback"
+                    break
+                decision["skipped"].append({"model": model, "reason": reason})
+            else:
+                fitting = [model for model in models if self._fits(model, prompt_tokens)]
+
+                def latency(model):
+                    stats = self._fresh_stats(stage, model)
+                    return (stats["latency_ms"] or 0.0) if stats else 0.0
+
+                decision["model"] = min(fitting, key=latency) if fitting else models[-1]
+                decision["reason"] = "all_degraded"
+
+        if decision["reason"] != "primary":
+            metrics.incr(f"model_fallbacks:{stage}")
+            print(f"Model routing for {stage}: {decision['model']} ({decision['reason']}, skipped {decision['skipped']})")
+        return decision
+
+    def available(self, stage: str) -> bool:
+        """False when every model of the stage has its circuit breaker open."""
+        return any(not breaker(model).is_open() for model in settings.llm_routes[stage])
+
+    def record(self, stage: str, model: str, latency_seconds: float, ok: bool):
+        latency_ms = latency_seconds * 1000
+        with self._lock:
+            stats = self._fresh_stats(stage, model)
+            if stats is None:
+                self._stats[(stage, model)] = {
+                    "latency_ms": latency_ms if ok else None,
+                    "error_rate": 0.0 if ok else 1.0,
+                    "samples": 1,
+                    "updated": time.monotonic(),
+                }
+                return
+            # Failed calls say nothing about how fast the model answers
+            if ok and stats["latency_ms"] is None:
+                stats["latency_ms"] = latency_ms
+            elif ok:
+                stats["latency_ms"] += EWMA_ALPHA * (latency_ms - stats["latency_ms"])
+            stats["error_rate"] += EWMA_ALPHA * ((0.0 if ok else 1.0) - stats["error_rate"])
+            stats["samples"] += 1
+            stats["updated"] = time.monotonic()
+
+    @staticmethod
+    def _budget_limited(stage: str, budget) -> bool:
+        """True when the budget, not the model, sets the call's timeout."""
+        if budget is None:
+            return False
+        timeouts = settings.openai_stage_timeouts
+        stage_seconds = timeouts.get(TIMEOUT_STAGES.get(stage, stage), timeouts["main"])
+        return budget.timeout() < stage_seconds
+
+    def call(self, stage: str, fn, prompt_tokens: int = 0, budget=None):
+        """
+        Runs fn(model) with the model chosen for the stage and records its
+        latency and outcome; after a model error it retries with the next model
+        of the route. Each attempt's decision is added to budget.model_decisions.
+        Returns the model and fn's result; the last exception is re-raised.
+        """
+        tried = []
+        while True:
+            decision = self.choose(stage, prompt_tokens, exclude=tuple(tried))
+            if tried:
+                decision["retry_of"] = tried[-1]
+            if budget is not None:
+                budget.model_decisions.append(decision)
+            budget_limited = self._budget_limited(stage, budget)
+            start = time.perf_counter()
+            try:
+                result = fn(decision["model"])
+            except Exception as e:
+                elapsed = time.perf_counter() - start
+                decision["ok"] = False
+                decision["error"] = type(e).__name__
+                model_error = is_model_error(e) and not (budget_limited and isinstance(e, openai.APITimeoutError))
+                if not model_error:
+                    raise
+                self.record(stage, decision["model"], elapsed, False)
+                tried.append(decision["model"])
+                remaining = [
+                    model for model in settings.llm_routes[stage]
+                    if model not in tried and model in settings.llm_prices and self._fits(model, prompt_tokens)
+                ]
+                if not remaining or (budget is not None and budget.remaining_seconds() <= 0):
+                    raise
+                metrics.incr(f"model_retries:{stage}")
+                print(f"Model {decision['model']} failed on {stage} ({decision['error']}), retrying with the next model")
+                continue
+            elapsed = time.perf_counter() - start
+            self.record(stage, decision["model"], elapsed, True)
+            decision["ok"] = True
+            decision["latency_ms"] = round(elapsed * 1000, 1)
+            return decision["model"], result
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                f"{stage}:{model}": {
+                    "latency_ms": round(stats["latency_ms"], 1) if stats["latency_ms"] is not None else None,
+                    "error_rate": round(stats["error_rate"], 3),
+                    "samples": stats["samples"],
+                    "age_seconds": round(time.monotonic() - stats["updated"], 1),
+                }
+                for (stage, model), stats in self._stats.items()
+            }
+
+
+model_router = ModelRouter()
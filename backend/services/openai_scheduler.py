@@ -0,0 +1,263 @@
+import contextvars
+import itertools
+import json
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+import httpx
+from services.metrics import metrics
+
+INTERACTIVE = "interactive"
+BULK = "bulk"
+# Lower rank is dispatched first
+PRIORITY_RANKS = {INTERACTIVE: 0, BULK: 1}
+
+_priority = ContextVar("openai_priority", default=INTERACTIVE)
+# Who the calls are made for; calls of one priority class take turns between clients
+_client = ContextVar("openai_client", default="")
+
+
+@contextmanager
+def priority(name: str):
+    """
+    Runs the OpenAI calls made in this block (in this thread) with the given
+    priority class. Calls default to INTERACTIVE; ingest and other offline
+    work wraps itself in priority(BULK).
+    """
+    if name not in PRIORITY_RANKS:
+        raise ValueError(f"Unknown priority: {name}")
+    token = _priority.set(name)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def current_priority() -> str:
+    return _priority.get()
+
+
+@contextmanager
+def scheduling_client(client_id: str):
+    """Attributes the OpenAI calls made in this block (in this thread) to a client."""
+    token = _client.set(client_id)
+    try:
+        yield
+    finally:
+        _client.reset(token)
+
+
+def current_client() -> str:
+    return _client.get()
+
+
+def in_current_context(fn):
+    """
+    Wraps fn to run with the caller's priority and client in whichever thread
+    calls it. Each call gets its own copy, so the wrapper can be used by many
+    pool threads at once.
+    """
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.copy().run(fn, *args, **kwargs)
+
+
+class TokenBucket:
+    """Refills `capacity` units per minute, continuously."""
+
+    def __init__(self, capacity: float):
+        self.capacity = capacity
+        self.level = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def wait_time(self, amount: float, reserve: float = 0.0) -> float:
+        """Seconds until `amount` can be taken while leaving `reserve` of capacity untouched."""
+        needed = min(amount, self.capacity) + reserve * self.capacity
+        if self.level >= needed:
+            return 0.0
+        return (needed - self.level) * 60 / self.capacity
+
+    def sync(self, limit: str | None, remaining: str | None):
+        """Adopts the limit and remaining count OpenAI reports in x-ratelimit-* headers."""
+        try:
+            if limit is not None:
+                self.capacity = max(float(limit), 1.0)
+            if remaining is not None:
+                self.level = min(self.level, float(remaining))
+        except ValueError:
+            pass
+        self.level = min(self.level, self.capacity)
+
+
+class FairQueue:
+    """
+    Waiting calls of one model. Priority classes are strict (every queued
+    interactive call goes before any bulk call); within a class, clients take
+    turns round-robin and each client's calls go in arrival order, so one
+    client with many calls can't starve the others of its class.
+    """
+
+    def __init__(self):
+        # Per class: client -> its tickets, in the order clients get their next turn
+        self._classes = {name: OrderedDict() for name in sorted(PRIORITY_RANKS, key=PRIORITY_RANKS.get)}
+
+    def push(self, priority_name: str, client_id: str, ticket: int):
+        self._classes[priority_name].setdefault(client_id, deque()).append(ticket)
+
+    def head(self) -> int | None:
+        for clients in self._classes.values():
+            if clients:
+                return next(iter(clients.values()))[0]
+        return None
+
+    def pop(self):
+        """Removes the head; its client moves to the back of its class."""
+        for clients in self._classes.values():
+            if clients:
+                client_id, tickets = next(iter(clients.items()))
+                tickets.popleft()
+                if tickets:
+                    clients.move_to_end(client_id)
+                else:
+                    del clients[client_id]
+                return
+
+
+class Scheduler:
+    """
+    Process-wide queue for OpenAI calls.
+
+    Each model has an RPM and a TPM token bucket and a FairQueue; only the head
+    of a model's queue may take from the buckets, so interactive calls always
+    go before queued bulk calls and clients of the same class take turns. Bulk
+    calls additionally leave `bulk_reserve` of both buckets free for
+    interactive traffic.
+
+    Buckets start at the default limits and follow the x-ratelimit-* headers of
+    every response; a 429 empties them so the queue backs off until they refill.
+    """
+
+    def __init__(self, default_rpm: int, default_tpm: int, bulk_reserve: float = 0.2):
+        self.default_rpm = default_rpm
+        self.default_tpm = default_tpm
+        self.bulk_reserve = bulk_reserve
+        self._cond = threading.Condition()
+        self._buckets = {}
+        self._queues = {}
+        self._depth = {name: 0 for name in PRIORITY_RANKS}
+        self._seq = itertools.count()
+
+    def _model_buckets(self, model: str) -> tuple[TokenBucket, TokenBucket]:
+        if model not in self._buckets:
+            self._buckets[model] = (TokenBucket(self.default_rpm), TokenBucket(self.default_tpm))
+        return self._buckets[model]
+
+    def _set_depth(self, name: str, delta: int):
+        self._depth[name] += delta
+        metrics.set(f"openai_queue_depth:{name}", self._depth[name])
+
+    def acquire(
+        self, model: str, tokens: int, priority_name: str | None = None, client_id: str | None = None
+    ) -> float:
+        """Blocks until the call may be sent. Returns the seconds spent waiting."""
+        priority_name = priority_name or current_priority()
+        client_id = current_client() if client_id is None else client_id
+        reserve = self.bulk_reserve if priority_name == BULK else 0.0
+        ticket = next(self._seq)
+        started = time.monotonic()
+
+        with self._cond:
+            queue = self._queues.setdefault(model, FairQueue())
+            queue.push(priority_name, client_id, ticket)
+            self._set_depth(priority_name, 1)
+            requests, token_bucket = self._model_buckets(model)
+            while True:
+                timeout = 1.0
+                if queue.head() == ticket:
+                    now = time.monotonic()
+                    requests.refill(now)
+                    token_bucket.refill(now)
+                    timeout = max(requests.wait_time(1, reserve), token_bucket.wait_time(tokens, reserve))
+                    if timeout <= 0:
+                        break
+                self._cond.wait(timeout)
+
+            queue.pop()
+            requests.level -= 1
+            token_bucket.level -= min(tokens, token_bucket.capacity)
+            self._set_depth(priority_name, -1)
+            # The next ticket in line may be able to go right away
+            self._cond.notify_all()
+
+        waited = time.monotonic() - started
+        metrics.incr(f"openai_queue_requests:{priority_name}")
+        metrics.incr(f"openai_queue_wait_seconds:{priority_name}", waited)
+        return waited
+
+    def update(self, model: str, response: httpx.Response):
+        """Resizes the model's buckets from the response's rate limit headers."""
+        headers = response.headers
+        with self._cond:
+            requests, token_bucket = self._model_buckets(model)
+            requests.sync(headers.get("x-ratelimit-limit-requests"), headers.get("x-ratelimit-remaining-requests"))
+            token_bucket.sync(headers.get("x-ratelimit-limit-tokens"), headers.get("x-ratelimit-remaining-tokens"))
+            if response.status_code == 429:
+                metrics.incr(f"openai_rate_limited:{model}")
+                requests.level = min(requests.level, 0)
+                token_bucket.level = min(token_bucket.level, 0)
+            self._cond.notify_all()
+
+
+def _text_length(value) -> int:
+    """Characters of text in a request body; inline images (data URLs) aren't counted."""
+    if isinstance(value, str):
+        return 0 if value.startswith("data:") else len(value)
+    if isinstance(value, dict):
+        return sum(_text_length(v) for v in value.values())
+    if isinstance(value, list):
+        return sum(_text_length(v) for v in value)
+    return 0
+
+
+def estimate_request(request: httpx.Request) -> tuple[str | None, int]:
+    """
+    Returns the model and estimated TPM cost of an OpenAI request: ~4 characters
+    per prompt token plus the requested output limit, which is how OpenAI
+    counts a request against the token limit.
+    """
+    try:
+        body = json.loads(request.content or b"{}")
+    except (ValueError, httpx.RequestNotRead):
+        return None, 0
+    if not isinstance(body, dict):
+        return None, 0
+    output_tokens = (
+        body.get("max_completion_tokens") or body.get("max_tokens") or body.get("max_output_tokens") or 0
+    )
+    prompt_tokens = _text_length({k: v for k, v in body.items() if k != "model"}) // 4
+    return body.get("model"), prompt_tokens + output_tokens
+
+
+class SchedulingTransport(httpx.BaseTransport):
+    """httpx transport that passes every model call through the scheduler."""
+
+    def __init__(self, scheduler: Scheduler, transport: httpx.BaseTransport | None = None):
+        self.scheduler = scheduler
+        self.transport = transport or httpx.HTTPTransport()
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        model, tokens = estimate_request(request)
+        if model is None:
+            return self.transport.handle_request(request)
+        self.scheduler.acquire(model, tokens)
+        response = self.transport.handle_request(request)
+        self.scheduler.update(model, response)
+        return response
+
+    def close(self):
+        self.transport.close()
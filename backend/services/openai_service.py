@@ -1,12 +1,65 @@
 import os
-from openai import OpenAI
+import httpx
+from openai import OpenAI, DefaultHttpxClient
+from config import settings
+from services.openai_scheduler import (
+    Scheduler,
+    SchedulingTransport,
+    priority,
+    scheduling_client,
+    in_current_context,
+    BULK,
+    INTERACTIVE,
+)
+from services.resilience import BreakerTransport, breaker, hedged
 
+# Shared by every client in the process, so chat and ingest see the same limits
+scheduler = Scheduler(
+    default_rpm=settings.openai_default_rpm,
+    default_tpm=settings.openai_default_tpm,
+    bulk_reserve=settings.openai_bulk_reserve,
+)
 
-def _build_client():
+
+def stage_timeout(stage: str, budget=None) -> httpx.Timeout:
+    """
+    Timeout for one pipeline stage's OpenAI call: the stage's read timeout,
+    capped by what's left of the request budget. For streamed calls the read
+    timeout bounds the wait for each chunk, not the whole answer.
+    """
+    seconds = settings.openai_stage_timeouts.get(stage, settings.openai_stage_timeouts["main"])
+    if budget is not None:
+        seconds = min(seconds, budget.timeout())
+    return httpx.Timeout(seconds, connect=settings.openai_connect_timeout)
+
+
+def _build_transport() -> httpx.BaseTransport:
+    transport = httpx.HTTPTransport(
+        http2=settings.openai_http2,
+        limits=httpx.Limits(
+            max_connections=settings.openai_max_connections,
+            max_keepalive_connections=settings.openai_max_keepalive_connections,
+            keepalive_expiry=settings.openai_keepalive_expiry_seconds,
+        ),
+    )
+    if settings.openai_scheduler:
+        transport = SchedulingTransport(scheduler, transport)
+    # Outermost, so calls refused by an open breaker don't take rate limit capacity
+    return BreakerTransport(transport)
+
+
+def _build_client(base_url: str | None = None):
     api_key = os.environ.get("OPENAI_API_KEY")
     if not api_key:
         raise RuntimeError("OPENAI_API_KEY environment variable is not set")
-    return OpenAI(api_key=api_key)
+    # Retries use the SDK's exponential backoff with jitter (and honor Retry-After)
+    return OpenAI(
+        api_key=api_key,
+        base_url=base_url,
+        max_retries=settings.openai_max_retries,
+        timeout=stage_timeout("main"),
+        http_client=DefaultHttpxClient(transport=_build_transport()),
+    )
 
 
-client = _build_client()
\ No newline at end of file
+client = _build_client()
@@ -0,0 +1,103 @@
+import hashlib
+import json
+import threading
+from datetime import datetime, timedelta, timezone
+from cachetools import TTLCache
+from config import settings
+from services.metrics import metrics
+
+
+def memo_key(notebook: str, version, refined_query: str, prompt_version: str) -> str:
+    parts = [notebook, version, hashlib.sha256(refined_query.encode("utf-8")).hexdigest(), prompt_version]
+    return hashlib.sha256(json.dumps(parts).encode("utf-8")).hexdigest()
+
+
+class PrefetchMemo:
+    """
+    Memo of per-notebook prefetch output.
+
+    The notebook content version is part of the key, so re-ingesting a notebook
+    makes its old entries unreachable; the Postgres backend also deletes them
+    when a newer version is stored. Failures of the Postgres backend are logged
+    and treated as misses.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float, backend: str = "memory"):
+        self.ttl_seconds = ttl_seconds
+        self.backend = backend
+        self._entries = TTLCache(maxsize=max_entries, ttl=ttl_seconds)
+        self._lock = threading.Lock()
+
+    def get_many(self, notebooks: list[str], versions: dict, refined_query: str, prompt_version: str) -> dict:
+        """Returns {notebook: value} for the notebooks with a memoized prefetch."""
+        keys = {
+            memo_key(notebook, versions.get(notebook), refined_query, prompt_version): notebook
+            for notebook in notebooks
+            if versions.get(notebook) is not None
+        }
+        hits = {}
+        with self._lock:
+            for key, notebook in keys.items():
+                if key in self._entries:
+                    hits[notebook] = self._entries[key]
+
+        missing = [key for key, notebook in keys.items() if notebook not in hits]
+        if missing and self.backend == "postgres":
+            for key, value in self._db_get(missing).items():
+                hits[keys[key]] = value
+                with self._lock:
+                    self._entries[key] = value
+
+        metrics.incr("prefetch_memo_hits", len(hits))
+        metrics.incr("prefetch_memo_misses", len(notebooks) - len(hits))
+        return hits
+
+    def set(self, notebook: str, version, refined_query: str, prompt_version: str, value: dict):
+        if version is None:
+            return
+        key = memo_key(notebook, version, refined_query, prompt_version)
+        with self._lock:
+            self._entries[key] = value
+        if self.backend == "postgres":
+            self._db_set(key, notebook, version, value)
+
+    def _db_get(self, keys: list[str]) -> dict:
+        from database import SessionLocal
+        from models import PrefetchMemoEntry
+
+        try:
+            cutoff = datetime.now(timezone.utc) - timedelta(seconds=self.ttl_seconds)
+            with SessionLocal() as db:
+                rows = (
+                    db.query(PrefetchMemoEntry)
+                    .filter(PrefetchMemoEntry.key.in_(keys), PrefetchMemoEntry.created_at >= cutoff)
+                    .all()
+                )
+                return {row.key: row.value for row in rows}
+        except Exception as e:
+            print(f"Error reading prefetch memo: {e}")
+            return {}
+
+    def _db_set(self, key: str, notebook: str, version, value: dict):
+        from database import SessionLocal
+        from models import PrefetchMemoEntry
+
+        try:
+            with SessionLocal() as db:
+                # Entries of older notebook versions can never be hit again
+                db.query(PrefetchMemoEntry).filter(
+                    PrefetchMemoEntry.notebook == notebook, PrefetchMemoEntry.version != version
+                ).delete(synchronize_session=False)
+                db.merge(PrefetchMemoEntry(
+                    key=key, notebook=notebook, version=version, value=value, created_at=datetime.now(timezone.utc)
+                ))
+                db.commit()
+        except Exception as e:
+            print(f"Error writing prefetch memo: {e}")
+
+
+prefetch_memo = PrefetchMemo(
+    max_entries=settings.prefetch_memo_max_entries,
+    ttl_seconds=settings.prefetch_memo_ttl_seconds,
+    backend=settings.prefetch_memo_backend,
+)
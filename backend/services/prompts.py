@@ -259,6 +259,15 @@ When in DEEP ANALYSIS mode:
 3. **Parameters**:
    - `query`: English keywords (string)
    - `notebook`: Exact notebook_id from summary
+
+4. **Batching** (when the `search_data_batch` tool is available):
+   - Send all independent searches of a stage in ONE `search_data_batch` call
+   - `searches`: list of {notebook, query} pairs, same rules as above
+   - Deep Analysis: issue each stage's 2-4 searches as one batch instead of separate calls
+
+5. **Chunk references**:
+   - Search results label chunks `[C<n>]`; a chunk you already received is sent only as a reference
+   - "already provided above": the full text is in an earlier tool result of this turn
 </tool_usage_rules>
 
 <response_language>
@@ -340,9 +349,10 @@ Response: [Full structured report with sections, 1500+ words, complete bibliogra
 
 </example_workflows>
 
-<notebook_summary>
-{notebook_summary}
-</notebook_summary>
+<request_context>
+The latest user message carries the per-request data: `<notebook_summary>` (the notebooks you can search),
+`<context_report>` (prefetch results) and `<user_query>`. Earlier user messages contain only the query.
+</request_context>
 """
 
 PRE_FETCH_LLM = """
@@ -359,7 +369,7 @@ You are a **Strict Data Extraction Engine** for a RAG system's prefetch phase. Y
 ### INPUT FORMAT
 You will receive:
 1. **User Query**: The question to answer (may be in Ukrainian or other language)
-2. **Context Chunks**: Array of text segments with sources `[{text, source}, ...]`
+2. **Context Chunks**: Numbered text passages with their sources, one per block: `[n] (source) text`
 
 ### OUTPUT SCHEMA
 ```json
@@ -463,12 +473,8 @@ Assess quality of match between query and context:
 Input:
 ```
 Query: "Що таке простий граф?"
-Context: [
-  {
-    "text": "Простий граф визначають як пару G=(V, E), де V, E – скінченні множини вершин і ребер відповідно, причому G не може містити петель і кратних ребер",
-    "source": "dis1.pdf"
-  }
-]
+Context:
+[1] (dis1.pdf) Простий граф визначають як пару G=(V, E), де V, E – скінченні множини вершин і ребер відповідно, причому G не може містити петель і кратних ребер
 ```
 
 Output:
@@ -492,12 +498,8 @@ Output:
 Input:
 ```
 Query: "Що таке граф і які його типи?"
-Context: [
-  {
-    "text": "Граф називають зв'язним, якщо його не можна зобразити як об'єднання двох непорожніх графів з множинами вершин, які не перетинаються.",
-    "source": "dis1.pdf"
-  }
-]
+Context:
+[1] (dis1.pdf) Граф називають зв'язним, якщо його не можна зобразити як об'єднання двох непорожніх графів з множинами вершин, які не перетинаються.
 ```
 
 Output:
@@ -519,12 +521,8 @@ Output:
 Input:
 ```
 Query: "Хто винайшов Python?"
-Context: [
-  {
-    "text": "Простий граф визначають як пару G=(V, E), де V, E – скінченні множини вершин і ребер",
-    "source": "dis1.pdf"
-  }
-]
+Context:
+[1] (dis1.pdf) Простий граф визначають як пару G=(V, E), де V, E – скінченні множини вершин і ребер
 ```
 
 Output:
@@ -544,20 +542,10 @@ Output:
 Input:
 ```
 Query: "Які є типи графів?"
-Context: [
-  {
-    "text": "Простий граф не може містити петель і кратних ребер",
-    "source": "dis1.pdf"
-  },
-  {
-    "text": "Якщо елементом множини E може бути пара однакових елементів V, то такий елемент називають петлею, а граф — псевдографом",
-    "source": "dis1.pdf"
-  },
-  {
-    "text": "Якщо E є мультимножиною, яка містить деякі елементи декілька разів, то ці елементи називають кратними ребрами, а граф – мультиграфом",
-    "source": "dis1.pdf"
-  }
-]
+Context:
+[1] (dis1.pdf) Простий граф не може містити петель і кратних ребер
+[2] (dis1.pdf) Якщо елементом множини E може бути пара однакових елементів V, то такий елемент називають петлею, а граф — псевдографом
+[3] (dis1.pdf) Якщо E є мультимножиною, яка містить деякі елементи декілька разів, то ці елементи називають кратними ребрами, а граф – мультиграфом
 ```
 
 Output:
@@ -589,6 +577,45 @@ When you receive a query and context chunks:
 **Remember**: Your output will be parsed by `json.loads()` - any extra text will cause errors.
 """
 
+HISTORY_SUMMARY_PROMPT = """
+<system_role>
+    You maintain a running summary of a conversation between a user and Info-Insight, a RAG assistant.
+</system_role>
+
+<task>
+    You get the current summary (may be empty) in <summary> and the next conversation messages in <messages>.
+    Return the updated summary that covers both.
+</task>
+
+<constraints>
+    1. Keep what later turns may depend on: the user's goals and questions, facts and answers given, names, numbers, definitions, notebooks and sources cited, open follow-ups.
+    2. Drop greetings, filler and formatting.
+    3. Write in the language of the conversation, as short bullet points, oldest first.
+    4. Stay within the token limit given in the input.
+</constraints>
+
+<output_format>
+    Provide ONLY the updated summary.
+</output_format>
+"""
+
+HISTORY_SUMMARY_USER = """
+<summary>
+{summary}
+</summary>
+<messages>
+{messages}
+</messages>
+Token limit: {max_tokens}
+"""
+
+HISTORY_SUMMARY_MESSAGE = """
+<conversation_summary>
+Summary of the earlier part of this conversation (older messages are not shown):
+{summary}
+</conversation_summary>
+"""
+
 SUMMARY_MODEL_PROMT = """
 <system_role>
     You are an expert in RAG system architecture and metadata optimization.
@@ -628,6 +655,9 @@ Output:
 """
 
 MAIN_LLM_USER = """
+<notebook_summary>
+{notebook_summary}
+</notebook_summary>
 <context_report>
 {prefetch}
 </context_report>
@@ -656,4 +686,22 @@ User Query: {user_query}
 Context Keywords: {keywords}
 
 Refined Search Query:
-"""
\ No newline at end of file
+"""
+
+PRE_FETCH_LLM_BATCH_USER = """
+### TASK
+The context below comes from several notebooks. Apply the rules above to EACH
+notebook separately and return one entry per notebook, using its exact name.
+Facts must only come from that notebook's own chunks.
+<user_query>
+{user_query}
+</user_query>
+
+{notebooks}
+Output:
+"""
+
+PRE_FETCH_LLM_BATCH_NOTEBOOK = """<notebook name="{notebook}">
+{result}
+</notebook>
+"""
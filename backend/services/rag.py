@@ -1,9 +1,18 @@
 import os
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 from qdrant_client import QdrantClient, models
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 
-from services.openai_service import client
+from config import settings
+from services.openai_service import client, priority, BULK, stage_timeout, hedged
+from services.embedding_batcher import EmbeddingBatcher
+
+
+# Службова колекція з центроїдом кожного блокноту для маршрутизації запитів
+ROUTING_COLLECTION = "_notebook_routing"
 
 
 def batch_generator(data, batch_size):
@@ -11,6 +20,83 @@ def batch_generator(data, batch_size):
         yield data[i : i + batch_size]
 
 
+def maximal_marginal_relevance(
+    query_vector: list[float], vectors: list[list[float]], limit: int, lambda_mult: float
+) -> list[int]:
+    """
+    Обирає індекси кандидатів за Maximal Marginal Relevance:
+    баланс між схожістю до запиту та відмінністю від уже обраних.
+    """
+    if not vectors:
+        return []
+    candidates = np.asarray(vectors, dtype=np.float64)
+    candidates /= np.linalg.norm(candidates, axis=1, keepdims=True) + 1e-12
+    query = np.asarray(query_vector, dtype=np.float64)
+    query /= np.linalg.norm(query) + 1e-12
+
+    relevance = candidates @ query
+    similarity = candidates @ candidates.T
+    selected = [int(np.argmax(relevance))]
+    while len(selected) < min(limit, len(vectors)):
+        remaining = [i for i in range(len(vectors)) if i not in selected]
+        redundancy = similarity[np.ix_(remaining, selected)].max(axis=1)
+        scores = lambda_mult * relevance[remaining] - (1 - lambda_mult) * redundancy
+        selected.append(remaining[int(np.argmax(scores))])
+    return selected
+
+
+# Коротші збіги кінця й початку чанків випадкові, а не перекриття сплітера
+MIN_CHUNK_OVERLAP = 20
+
+
+def _strip_overlap(left: str, right: str, max_overlap: int = 200) -> str | None:
+    """
+    Повертає right без префіксу, який уже є в кінці left (перекриття чанків),
+    або None, якщо перекриття щонайменше з MIN_CHUNK_OVERLAP символів немає.
+    """
+    for size in range(min(len(left), len(right), max_overlap), MIN_CHUNK_OVERLAP - 1, -1):
+        if left.endswith(right[:size]):
+            return right[size:]
+    return None
+
+
+def merge_adjacent_chunks(results: list[dict]) -> list[dict]:
+    """
+    Склеює сусідні чанки одного документа в один уривок без дубльованого перекриття.
+    Сусідство визначається за (doc_id, chunk_index): чанки без doc_id (завантажені
+    до його появи) не склеюються, бо індекси різних завантажень одного джерела збігаються.
+    Порядок уривків визначається найкращим чанком, score уривка - максимальний.
+    """
+    def adjacent(r: dict) -> bool:
+        return r.get("doc_id") is not None and r.get("chunk_index") is not None
+
+    indexed = [r for r in results if adjacent(r)]
+    passages = [dict(r, ids=[r["id"]]) for r in results if not adjacent(r)]
+
+    indexed.sort(key=lambda r: (r["doc_id"], r["chunk_index"]))
+    for result in indexed:
+        previous = passages[-1] if passages else None
+        if (
+            previous is not None
+            and "last_chunk_index" in previous
+            and previous["doc_id"] == result["doc_id"]
+            and result["chunk_index"] == previous["last_chunk_index"] + 1
+        ):
+            rest = _strip_overlap(previous["text"], result["text"])
+            # Без перекриття чанки з'єднуються через розрив рядка, щоб не склеїти слова
+            previous["text"] += rest if rest is not None else "\n" + result["text"]
+            previous["score"] = max(previous["score"], result["score"])
+            previous["ids"].append(result["id"])
+            previous["last_chunk_index"] = result["chunk_index"]
+        else:
+            passages.append(dict(result, ids=[result["id"]], last_chunk_index=result["chunk_index"]))
+
+    for passage in passages:
+        passage.pop("last_chunk_index", None)
+    passages.sort(key=lambda p: p["score"], reverse=True)
+    return passages
+
+
 class RAGService:
     def __init__(self, embedding_model: str = "text-embedding-3-small"):
         """
@@ -26,6 +112,13 @@ class RAGService:
         self.embedding_model = embedding_model
         self.vector_size = 1536
         self.batch_limit = 100
+        # Ембединги запитів з паралельних запитів збираються в один виклик OpenAI
+        self.query_batcher = EmbeddingBatcher(
+            self._embed,
+            window_ms=settings.embedding_batch_window_ms,
+            max_batch=settings.embedding_batch_max_items,
+            timeout_seconds=settings.embedding_batch_timeout_seconds,
+        )
 
     def create_notebook(self, notebook_id: str):
         """
@@ -38,6 +131,7 @@ class RAGService:
                     size=self.vector_size, distance=models.Distance.COSINE
                 ),
             )
+            self._reset_routing(notebook_id)
             print(f"Колекцію '{notebook_id}' успішно створено.")
         except Exception as e:
             # Qdrant може кинути помилку, якщо колекція вже існує з іншими параметрами
@@ -63,25 +157,180 @@ class RAGService:
         if not chunks:
             return True
 
-        all_points_to_upsert = self._insert_data_openai(chunks, source=source)
+        # Ембединги для індексації не повинні затримувати запити користувачів
+        with priority(BULK):
+            all_points_to_upsert = self._insert_data_openai(chunks, source=source)
 
         if all_points_to_upsert:
             self.client.upsert(
                 collection_name=notebook_id, points=all_points_to_upsert, wait=True
             )
+            self._update_routing(
+                notebook_id, [point.vector for point in all_points_to_upsert]
+            )
 
         return True
 
+    @staticmethod
+    def _routing_point_id(notebook_id: str) -> str:
+        return str(uuid.uuid5(uuid.NAMESPACE_URL, notebook_id))
+
+    def _ensure_routing_collection(self):
+        if not self.client.collection_exists(ROUTING_COLLECTION):
+            self.client.create_collection(
+                collection_name=ROUTING_COLLECTION,
+                vectors_config=models.VectorParams(
+                    size=self.vector_size, distance=models.Distance.COSINE
+                ),
+            )
+            self.client.create_payload_index(
+                collection_name=ROUTING_COLLECTION,
+                field_name="notebook",
+                field_schema=models.PayloadSchemaType.KEYWORD,
+            )
+
+    def _update_routing(self, notebook_id: str, vectors: list[list[float]]):
+        """
+        Оновлює центроїд блокноту ковзним середнім з новими векторами.
+        Помилки не блокують вставку даних - маршрутизація просто відкотиться до всіх блокнотів.
+        """
+        try:
+            self._ensure_routing_collection()
+            point_id = self._routing_point_id(notebook_id)
+            existing = self.client.retrieve(
+                collection_name=ROUTING_COLLECTION, ids=[point_id], with_vectors=True
+            )
+            new_vectors = np.asarray(vectors, dtype=np.float64)
+            total = new_vectors.sum(axis=0)
+            count = len(new_vectors)
+            if existing:
+                old_count = existing[0].payload.get("count", 0)
+                total += np.asarray(existing[0].vector, dtype=np.float64) * old_count
+                count += old_count
+            self.client.upsert(
+                collection_name=ROUTING_COLLECTION,
+                points=[
+                    models.PointStruct(
+                        id=point_id,
+                        vector=(total / count).tolist(),
+                        # version змінюється з кожним додаванням даних - за ним інвалідуються кеші
+                        payload={"notebook": notebook_id, "count": count, "version": time.time_ns()},
+                    )
+                ],
+                wait=True,
+            )
+        except Exception as err:
+            print(f"Помилка при оновленні індексу маршрутизації для '{notebook_id}': {err}")
+            self._bump_version(notebook_id)
+
+    def _bump_version(self, notebook_id: str):
+        """
+        Змінює версію блокноту без оновлення центроїда, щоб кеші не віддавали
+        застарілі відповіді. Якщо й це не вдалося, точка маршрутизації видаляється:
+        блокнот без версії не кешується.
+        """
+        try:
+            self.client.set_payload(
+                collection_name=ROUTING_COLLECTION,
+                payload={"version": time.time_ns()},
+                points=[self._routing_point_id(notebook_id)],
+                wait=True,
+            )
+        except Exception as err:
+            print(f"Помилка при оновленні версії блокноту '{notebook_id}': {err}")
+            self._reset_routing(notebook_id)
+
+    def _reset_routing(self, notebook_id: str):
+        try:
+            if self.client.collection_exists(ROUTING_COLLECTION):
+                self.client.delete(
+                    collection_name=ROUTING_COLLECTION,
+                    points_selector=models.PointIdsList(points=[self._routing_point_id(notebook_id)]),
+                )
+        except Exception as err:
+            print(f"Помилка при видаленні індексу маршрутизації для '{notebook_id}': {err}")
+
+    def rebuild_routing(self, notebook_id: str):
+        """
+        Перебудовує центроїд блокноту з усіх збережених векторів.
+        Потрібно для блокнотів, створених до появи індексу маршрутизації.
+        """
+        self._reset_routing(notebook_id)
+        offset = None
+        while True:
+            records, offset = self.client.scroll(
+                collection_name=notebook_id,
+                limit=self.batch_limit,
+                offset=offset,
+                with_vectors=True,
+                with_payload=False,
+            )
+            if records:
+                self._update_routing(notebook_id, [record.vector for record in records])
+            if offset is None:
+                break
+
+    def notebook_versions(self, notebooks: list[str]) -> dict[str, int | None] | None:
+        """
+        Повертає версію вмісту кожного блокноту (None для блокнотів без даних).
+        Версія оновлюється при кожному додаванні даних.
+        Якщо версії отримати не вдалося, повертає None - кешувати тоді не можна.
+        """
+        versions = {notebook: None for notebook in notebooks}
+        if not notebooks:
+            return versions
+        try:
+            if not self.client.collection_exists(ROUTING_COLLECTION):
+                return versions
+            records = self.client.retrieve(
+                collection_name=ROUTING_COLLECTION,
+                ids=[self._routing_point_id(notebook) for notebook in notebooks],
+                with_payload=True,
+            )
+            for record in records:
+                versions[record.payload["notebook"]] = record.payload.get("version")
+        except Exception as err:
+            print(f"Помилка при отриманні версій блокнотів: {err}")
+            return None
+        return versions
+
+    def route_notebooks(self, query_vector: list[float], notebooks: list[str]) -> dict[str, float]:
+        """
+        Оцінює близькість запиту до центроїдів блокнотів.
+
+        Returns:
+            Словник {notebook: score} лише для блокнотів, що мають центроїд.
+        """
+        if not notebooks or not self.client.collection_exists(ROUTING_COLLECTION):
+            return {}
+
+        response = self.client.query_points(
+            collection_name=ROUTING_COLLECTION,
+            query=query_vector,
+            query_filter=models.Filter(
+                must=[
+                    models.FieldCondition(
+                        key="notebook", match=models.MatchAny(any=list(notebooks))
+                    )
+                ]
+            ),
+            limit=len(notebooks),
+            with_payload=True,
+        )
+        return {point.payload["notebook"]: point.score for point in response.points}
+
     def _insert_data_openai(self, chunks: list[str], source: str | None = None) -> list:
         all_points_to_upsert = []
+        # Один doc_id на завантаження: chunk_index рахується з нуля в кожному
+        doc_id = uuid.uuid4().hex
 
-        for chunk_batch in batch_generator(chunks, self.batch_limit):
+        for batch_number, chunk_batch in enumerate(batch_generator(chunks, self.batch_limit)):
             try:
                 response = client.embeddings.create(
                     model=self.embedding_model,
                     input=chunk_batch,
                 )
-                for chunk_text, item in zip(chunk_batch, response.data):
+                for offset, (chunk_text, item) in enumerate(zip(chunk_batch, response.data)):
                     all_points_to_upsert.append(
                         models.PointStruct(
                             id=str(uuid.uuid4()),
@@ -89,6 +338,9 @@ class RAGService:
                             payload={
                                 "text": chunk_text,
                                 "source": source,
+                                "doc_id": doc_id,
+                                # Позиція чанку в документі - для склеювання сусідніх чанків
+                                "chunk_index": batch_number * self.batch_limit + offset,
                             },
                         )
                     )
@@ -98,65 +350,171 @@ class RAGService:
 
         return all_points_to_upsert
 
-    def _get_embedding(self, text: str) -> list[float]:
+    def embed_queries(self, texts: list[str]) -> list[list[float]]:
         """
-        Допоміжна функція для отримання одного вектора для запиту.
-        Використовує OpenAI embeddings.
+        Отримує вектори для кількох запитів одним викликом OpenAI.
+        З мікробатчингом цей виклик спільний з паралельними запитами інших користувачів.
+        Повертає порожній список, якщо ембединги отримати не вдалося.
         """
         try:
-            response = client.embeddings.create(
-                model=self.embedding_model,
-                input=[text],
-            )
-            if response.data:
-                return response.data[0].embedding
-            return []
+            if settings.embedding_batching:
+                return self.query_batcher.embed(texts)
+            return self._embed(texts)
         except Exception as err:
             print(f"Помилка при отриманні ембедингу запиту від OpenAI: {err}")
             return []
 
-    def search_data(self, notebook_id: str, query: str, limit: int = 5):
-        if not self.client.collection_exists(notebook_id):
-            raise ValueError(f"Колекція {notebook_id} не існує.")
+    def _embed(self, texts: list[str]) -> list[list[float]]:
+        # Ембединг запиту блокує відповідь, тож повільний виклик дублюється
+        response = hedged(
+            "embedding",
+            client.embeddings.create,
+            model=self.embedding_model,
+            input=texts,
+            timeout=stage_timeout("embedding"),
+        )
+        return [item.embedding for item in response.data]
 
-        query_vector = self._get_embedding(query)
+    def _get_embedding(self, text: str) -> list[float]:
+        """
+        Допоміжна функція для отримання одного вектора для запиту.
+        Використовує OpenAI embeddings.
+        """
+        vectors = self.embed_queries([text])
+        return vectors[0] if vectors else []
 
-        if not query_vector:
-            return []
+    @staticmethod
+    def _point_to_result(point) -> dict:
+        point = point[0] if isinstance(point, tuple) else point
+        payload = point.payload or {}
+        return {
+            "id": str(point.id),
+            "text": payload.get("text", ""),
+            "source": payload.get("source"),
+            "doc_id": payload.get("doc_id"),
+            "chunk_index": payload.get("chunk_index"),
+            "score": point.score,
+        }
 
-        search_results = self.client.query_points(
-            collection_name=notebook_id,
-            query=query_vector,
-            limit=limit,
-            with_payload=True,
-        )
+    def _query_collection(self, notebook_id: str, vectors: list[list[float]], limit: int):
+        """
+        Виконує всі запити до однієї колекції одним query_batch_points.
 
-        results = []
+        Якщо увімкнено retrieval_mmr, з колекції береться limit * mmr_fetch_factor
+        кандидатів, з них MMR обирає limit різноманітних, а сусідні чанки
+        одного джерела склеюються в один уривок.
+        """
+        use_mmr = settings.retrieval_mmr
+        fetch_limit = limit * settings.mmr_fetch_factor if use_mmr else limit
+        requests = [
+            models.QueryRequest(
+                query=vector, limit=fetch_limit, with_payload=True, with_vector=use_mmr
+            )
+            for vector in vectors
+        ]
+        responses = self.client.query_batch_points(
+            collection_name=notebook_id, requests=requests
+        )
 
-        if hasattr(search_results, "points"):
-            for point in search_results.points:
-                payload = point[0].payload if isinstance(point, tuple) else point.payload
-                results.append(
-                    {
-                        "text": payload.get("text", ""),
-                        "source": payload.get("source"),
-                    }
+        output = []
+        for vector, response in zip(vectors, responses):
+            points = response.points
+            if use_mmr:
+                picked = maximal_marginal_relevance(
+                    vector, [point.vector for point in points], limit, settings.mmr_lambda
                 )
+                points = [points[i] for i in picked]
+            results = [self._point_to_result(point) for point in points]
+            output.append(merge_adjacent_chunks(results) if use_mmr else results)
+        return output
+
+    def search_many(
+        self,
+        notebooks: list[str],
+        queries: list[str],
+        limit: int = 5,
+        query_vectors: list[list[float]] | None = None,
+    ) -> list[dict]:
+        """
+        Пошук по кількох блокнотах за один прохід.
+
+        Запит queries[i] виконується в блокноті notebooks[i]; якщо передано
+        лише один запит, він застосовується до всіх блокнотів. Усі унікальні
+        запити ембедяться одним викликом OpenAI, а кожна колекція отримує
+        рівно один query_batch_points (колекції опитуються паралельно).
+        Вже обчислені вектори запитів можна передати через query_vectors.
+
+        Returns:
+            Список у порядку вхідних пар:
+            {"notebook", "query", "results": [{"id", "text", "source", "doc_id", "chunk_index", "score"}]}
+            (з retrieval_mmr кожен результат - склеєний уривок з полем "ids"),
+            та "error", якщо пошук у блокноті не вдався.
+        """
+        if len(queries) == 1:
+            queries = queries * len(notebooks)
+        if len(queries) != len(notebooks):
+            raise ValueError("Кількість запитів має дорівнювати кількості блокнотів.")
+
+        output = [
+            {"notebook": notebook, "query": query, "results": []}
+            for notebook, query in zip(notebooks, queries)
+        ]
+        if not output:
+            return output
+
+        if query_vectors is not None:
+            if len(query_vectors) == 1:
+                query_vectors = query_vectors * len(notebooks)
+            vector_by_query = dict(zip(queries, query_vectors))
         else:
-            for item in search_results:
-                payload = item[0].payload if isinstance(item, tuple) else item.payload
-                results.append(
-                    {
-                        "text": payload.get("text", ""),
-                        "source": payload.get("source"),
-                    }
+            unique_queries = list(dict.fromkeys(queries))
+            vectors = self.embed_queries(unique_queries)
+            if not vectors:
+                return output
+            vector_by_query = dict(zip(unique_queries, vectors))
+
+        # Групуємо пари за колекцією: одна колекція - один запит до Qdrant
+        by_notebook: dict[str, list[int]] = {}
+        for index, notebook in enumerate(notebooks):
+            by_notebook.setdefault(notebook, []).append(index)
+
+        def run(notebook: str):
+            indexes = by_notebook[notebook]
+            try:
+                return self._query_collection(
+                    notebook, [vector_by_query[queries[i]] for i in indexes], limit
                 )
+            except Exception as err:
+                return err
+
+        with ThreadPoolExecutor(max_workers=len(by_notebook)) as executor:
+            responses = dict(zip(by_notebook, executor.map(run, by_notebook)))
+
+        for notebook, indexes in by_notebook.items():
+            response = responses[notebook]
+            if isinstance(response, Exception):
+                print(f"Помилка пошуку в колекції '{notebook}': {response}")
+                for i in indexes:
+                    output[i]["error"] = f"Колекція {notebook} недоступна: {response}"
+                continue
+            for i, results in zip(indexes, response):
+                output[i]["results"] = results
+
+        return output
+
+    def search_data(self, notebook_id: str, query: str, limit: int = 5):
+        if not self.client.collection_exists(notebook_id):
+            raise ValueError(f"Колекція {notebook_id} не існує.")
 
-        return results
+        entry = self.search_many([notebook_id], [query], limit)[0]
+        if "error" in entry:
+            raise ValueError(entry["error"])
+        return entry["results"]
 
     def delete_notebook(self, notebook_id: str):
         if self.client.collection_exists(notebook_id):
             self.client.delete_collection(notebook_id)
+            self._reset_routing(notebook_id)
         else:
             raise ValueError(f"Колекція {notebook_id} не існує.")
 
@@ -180,7 +538,11 @@ class RAGService:
         """
         try:
             collections = self.client.get_collections()
-            return [collection.name for collection in collections.collections]
+            return [
+                collection.name
+                for collection in collections.collections
+                if collection.name != ROUTING_COLLECTION
+            ]
         except Exception as e:
             print(f"Помилка при отриманні списку колекцій: {e}")
             return []
@@ -0,0 +1,145 @@
+import contextvars
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import httpx
+from config import settings
+from services.metrics import metrics
+from services.openai_scheduler import estimate_request
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """
+    Trips after `failure_threshold` consecutive failures. While open, calls are
+    refused for `reset_seconds`; after that a single probe call is let through
+    and its outcome closes the breaker or opens it again.
+    """
+
+    def __init__(self, name: str, failure_threshold: int, reset_seconds: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def is_open(self) -> bool:
+        """True while calls would be refused (probes aside)."""
+        with self._lock:
+            return self.state == OPEN and time.monotonic() - self.opened_at < self.reset_seconds
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_seconds:
+                # This caller is the probe, everyone else keeps failing fast
+                self.state = HALF_OPEN
+                return True
+            return False
+
+    def record(self, success: bool):
+        with self._lock:
+            if success:
+                if self.state != CLOSED:
+                    print(f"Circuit breaker {self.name} closed")
+                self.state = CLOSED
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != OPEN:
+                    print(f"Circuit breaker {self.name} opened after {self.failures} failures")
+                    metrics.incr(f"circuit_breaker_opened:{self.name}")
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def breaker(model: str) -> CircuitBreaker:
+    """The process-wide breaker for a model."""
+    with _breakers_lock:
+        if model not in _breakers:
+            _breakers[model] = CircuitBreaker(
+                model, settings.breaker_failure_threshold, settings.breaker_reset_seconds
+            )
+        return _breakers[model]
+
+
+class BreakerTransport(httpx.BaseTransport):
+    """
+    httpx transport that tracks upstream health per model. 5xx responses and
+    any exception (timeouts, connection errors, cancellation) count as failures. While a model's breaker is
+    open, its calls get an immediate 503 marked `x-should-retry: false`, so the
+    SDK raises instead of retrying.
+    """
+
+    def __init__(self, transport: httpx.BaseTransport):
+        self.transport = transport
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        model, _ = estimate_request(request)
+        if model is None:
+            return self.transport.handle_request(request)
+        model_breaker = breaker(model)
+        if not model_breaker.allow():
+            metrics.incr(f"circuit_breaker_rejected:{model}")
+            return httpx.Response(
+                503,
+                headers={"x-should-retry": "false"},
+                json={"error": {"message": f"Circuit open for {model}", "type": "circuit_open"}},
+                request=request,
+            )
+        # Recorded whatever happens, so a probe that raises can't leave the breaker half-open
+        success = False
+        try:
+            response = self.transport.handle_request(request)
+            success = response.status_code < 500
+            return response
+        finally:
+            model_breaker.record(success)
+
+    def close(self):
+        self.transport.close()
+
+
+_hedge_executor = ThreadPoolExecutor(max_workers=64, thread_name_prefix="openai-hedge")
+
+
+def hedged(stage: str, fn, *args, **kwargs):
+    """
+    Calls fn(*args, **kwargs); if it hasn't returned after the stage's hedge
+    delay, sends an identical second call and returns whichever succeeds first.
+    Only for small idempotent calls (query refinement, query embeddings).
+    """
+    delay_ms = settings.openai_hedge_delays_ms.get(stage, 0)
+    if not delay_ms:
+        return fn(*args, **kwargs)
+
+    # Copy the context so the calls keep the caller's scheduler priority
+    first = _hedge_executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+    done, _ = wait([first], timeout=delay_ms / 1000)
+    if done:
+        return first.result()
+
+    metrics.incr(f"hedge_requests:{stage}")
+    second = _hedge_executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+    pending = {first, second}
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                if future is second:
+                    metrics.incr(f"hedge_wins:{stage}")
+                return future.result()
+            error = future.exception()
+    raise error
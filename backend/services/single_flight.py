@@ -0,0 +1,42 @@
+import threading
+from concurrent.futures import Future
+from services.metrics import metrics
+
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent calls: while a call for a key is in flight,
+    other callers with the same key wait for it and share its result (or
+    exception) instead of starting their own. Nothing is cached afterwards.
+
+    Shared results must be treated as read-only by the callers.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args, **kwargs):
+        """Returns fn(*args, **kwargs), or the result of an identical call already in flight."""
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+
+        if not leader:
+            metrics.incr(f"single_flight_coalesced:{self.name}")
+            return future.result()
+
+        metrics.incr(f"single_flight_calls:{self.name}")
+        try:
+            result = fn(*args, **kwargs)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
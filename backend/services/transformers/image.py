@@ -1,5 +1,6 @@
 import json_repair
-from services.openai_service import client
+from services.openai_service import client, priority, BULK, stage_timeout
+from services.model_router import model_router
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 
 prompt = """
@@ -23,23 +24,26 @@ Rules:
 - Tags = 5–12 short searchable keywords.
 """
 
-ocr_model = "gpt-4o-mini"
-
-
 def image_recognition(images: list[str]) -> list[str]:
     image_request = [{"type": "input_image", "image_url": image} for image in images]
-    response = client.responses.create(
-        model="gpt-4o-mini",
-        input=[
-            {
-                "role": "user",
-                "content": [
-                    {"type": "input_text", "text": prompt},
-                ]
-                + image_request,
-            }
-        ],
-    )
+    # OCR runs during ingest, behind interactive chat traffic
+    with priority(BULK):
+        _, response = model_router.call(
+            "ocr",
+            lambda model: client.responses.create(
+                model=model,
+                input=[
+                    {
+                        "role": "user",
+                        "content": [
+                            {"type": "input_text", "text": prompt},
+                        ]
+                        + image_request,
+                    }
+                ],
+                timeout=stage_timeout("ocr"),
+            ),
+        )
     data = json_repair.loads(response.output_text)
     text_splitter = RecursiveCharacterTextSplitter(
         chunk_size=500,
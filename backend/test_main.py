@@ -1,9 +1,9 @@
-from services.prompts import MAIN_LLM_SYSTEM
 from services.rag import rag_service
 from services.ai_wrapper import execute_chat, summarize_notebooks
 
 notebooks=["discrete_math"]
-messages = [{"role": "system", "content": MAIN_LLM_SYSTEM.format(notebook_summary = summarize_notebooks(notebooks))}]
+notebook_summary = summarize_notebooks(notebooks)
+messages = []
 keywords = []
 while True:
     inp = input()
@@ -11,7 +11,7 @@ while True:
         "role" : "user",
         "content": inp
     })
-    res, logs = execute_chat(messages, keywords, notebooks)
+    res, logs = execute_chat(messages, keywords, notebooks, notebook_summary=notebook_summary)
     print("\n### RESPONSE\n{data}\n".format(data=res[-1]["content"]))
     for message in res:
         messages.append(message)
@@ -0,0 +1,146 @@
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from openai import OpenAI
+
+os.environ.setdefault("OPENAI_API_KEY", "test")
+from services.openai_service import _build_client, stage_timeout, hedged, breaker
+
+# Fault-injecting fake chat completions server: a normal response takes
+# BASE_LATENCY, some requests are slow, stall or fail with a 500
+BASE_LATENCY = 0.1
+SLOW_RATE = 0.05
+SLOW_LATENCY = 4.0
+STALL_RATE = 0.01
+STALL_LATENCY = 20.0
+ERROR_RATE = 0.05
+
+faults = random.Random(42)
+faults_lock = threading.Lock()
+
+
+class FaultyHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with faults_lock:
+            roll = faults.random()
+        if roll < ERROR_RATE:
+            self._send(500, {"error": {"message": "injected failure", "type": "server_error"}})
+            return
+        roll -= ERROR_RATE
+        if roll < STALL_RATE:
+            time.sleep(STALL_LATENCY)
+        elif roll < STALL_RATE + SLOW_RATE:
+            time.sleep(SLOW_LATENCY)
+        else:
+            time.sleep(BASE_LATENCY)
+        self._send(200, {
+            "id": "chatcmpl-test",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body["model"],
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": "refined query"},
+                "finish_reason": "stop",
+            }],
+            "usage": {"prompt_tokens": 10, "completion_tokens": 2, "total_tokens": 12},
+        })
+
+    def _send(self, status: int, data: dict):
+        payload = json.dumps(data).encode("utf-8")
+        try:
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.send_header("x-ratelimit-limit-requests", "100000")
+            self.send_header("x-ratelimit-limit-tokens", "100000000")
+            self.end_headers()
+            self.wfile.write(payload)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client gave up on this request (timeout or lost hedge)
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FaultyServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+
+requests_total = 300
+concurrency = 16
+messages = [{"role": "user", "content": "What is a spanning tree?"}]
+
+
+def run_load(call):
+    def timed(_):
+        start = time.perf_counter()
+        try:
+            call()
+            ok = True
+        except Exception:
+            ok = False
+        return time.perf_counter() - start, ok
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(timed, range(requests_total)))
+    elapsed = time.perf_counter() - start
+    latencies = sorted(latency for latency, _ in results)
+    return {
+        "seconds": round(elapsed, 1),
+        "errors": sum(1 for _, ok in results if not ok),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 1),
+        "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1] * 1000, 1),
+        "p99_ms": round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 1),
+    }
+
+
+def run_tests():
+    server = FaultyServer(("127.0.0.1", 0), FaultyHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}/v1"
+
+    # What _build_client used to create: default timeouts and retries
+    baseline_client = OpenAI(api_key="test", base_url=base_url)
+    tuned_client = _build_client(base_url)
+
+    def baseline():
+        baseline_client.chat.completions.create(model="gpt-3.5-turbo", messages=messages, temperature=0)
+
+    def tuned():
+        hedged(
+            "refine",
+            tuned_client.chat.completions.create,
+            model="gpt-3.5-turbo",
+            messages=messages,
+            temperature=0,
+            timeout=stage_timeout("refine"),
+        )
+
+    results = {}
+    for name, call in (("baseline", baseline), ("tuned", tuned)):
+        results[name] = run_load(call)
+        r = results[name]
+        print(
+            f"{name:>8}: p50 {r['p50_ms']} ms, p95 {r['p95_ms']} ms, p99 {r['p99_ms']} ms, "
+            f"{r['errors']} errors, {r['seconds']}s total"
+        )
+    results["breaker_state"] = breaker("gpt-3.5-turbo").state
+    print(f"Circuit breaker for gpt-3.5-turbo: {results['breaker_state']}")
+
+    server.shutdown()
+    with open("transport_test_results.json", "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2, ensure_ascii=False)
+
+    print("Results saved to transport_test_results.json")
+
+if __name__ == "__main__":
+    run_tests()